@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import sys
+import shutil
+import tempfile
+import time
+import platform
+import numpy as np
+import cv2
+import scipy
+from scipy.cluster.vq import vq
+
+import feature_cache
+import triangle_generator
+import edge_index
+import vocabulary
+from lshash import LSHash
+from training_handler import TrainingHandler
+from recognizer import Recognizer
+
+# USAGE:
+#   python benchmark.py --output ../benchmarks/today.json
+# Times every stage of training and recognition on generated logo images and
+# writes the timings as JSON, compare two runs to find regressions.
+
+BENCHMARK_FORMAT_VERSION = 1
+
+
+def syntheticLogo(random, size=96):
+    # A logo made of random filled shapes, lines and letters on white
+    logo = np.full((size, size, 3), 255, np.uint8)
+    for _ in range(random.randint(3, 7)):
+        color = tuple(int(c) for c in random.randint(0, 200, 3))
+        kind = random.randint(3)
+        if kind == 0:
+            center = tuple(int(c) for c in random.randint(size//6, size - size//6, 2))
+            cv2.circle(logo, center, int(random.randint(size//10, size//4)), color, -1)
+        elif kind == 1:
+            points = random.randint(0, size, (random.randint(3, 6), 2)).astype(np.int32)
+            cv2.fillPoly(logo, [points], color)
+        else:
+            start = tuple(int(c) for c in random.randint(0, size, 2))
+            end = tuple(int(c) for c in random.randint(0, size, 2))
+            cv2.line(logo, start, end, color, int(random.randint(2, 6)))
+    letters = ''.join(chr(ord('A') + random.randint(26)) for _ in range(3))
+    cv2.putText(logo, letters, (size//8, size*5//8), cv2.FONT_HERSHEY_SIMPLEX, size/80.0, (0, 0, 0), 2)
+    return logo
+
+def syntheticScene(logo, random, width=320, height=240, noise=8.0):
+    # The logo rotated, scaled and sheared onto a cluttered background, with
+    # pixel noise on top
+    scene = np.empty((height, width, 3), np.uint8)
+    scene[:] = random.randint(60, 200, 3)
+    for _ in range(random.randint(10, 25)):
+        color = tuple(int(c) for c in random.randint(0, 256, 3))
+        center = (int(random.randint(width)), int(random.randint(height)))
+        axes = (int(random.randint(5, 40)), int(random.randint(5, 40)))
+        cv2.ellipse(scene, center, axes, float(random.uniform(0, 180)), 0, 360, color, -1)
+
+    size = logo.shape[0]
+    angle = random.uniform(-25, 25)
+    scale = random.uniform(0.7, 1.3)
+    affine = cv2.getRotationMatrix2D((size/2.0, size/2.0), angle, scale)
+    affine[0, 1] += random.uniform(-0.15, 0.15)
+    x = random.randint(0, max(1, width - int(size*1.5)))
+    y = random.randint(0, max(1, height - int(size*1.5)))
+    affine[:, 2] += (x, y)
+    warped = cv2.warpAffine(logo, affine, (width, height), borderValue=(0, 0, 0))
+    mask = cv2.warpAffine(np.full(logo.shape[:2], 255, np.uint8), affine, (width, height))
+    scene[mask > 0] = warped[mask > 0]
+
+    scene = scene.astype(float) + random.normal(0, noise, scene.shape)
+    return np.clip(scene, 0, 255).astype(np.uint8)
+
+def generateImages(dirPath, trainCount, queryCount, seed=0):
+    # Training scenes of one logo, and query scenes of which half show it.
+    # Returns the paths of both.
+    random = np.random.RandomState(seed)
+    logo = syntheticLogo(random)
+    other = syntheticLogo(random)
+    trainPaths = []
+    queryPaths = []
+    for i in range(trainCount):
+        trainPaths.append(os.path.join(dirPath, 'train%03d.png' % i))
+        cv2.imwrite(trainPaths[-1], syntheticScene(logo, random))
+    for i in range(queryCount):
+        queryPaths.append(os.path.join(dirPath, 'query%03d.png' % i))
+        cv2.imwrite(queryPaths[-1], syntheticScene(logo if i % 2 == 0 else other, random))
+    return trainPaths, queryPaths
+
+
+def timeStage(name, function, repeat, items=1):
+    # Runs function repeat times, returns the timing record of the stage and
+    # the value of the last run
+    times = []
+    value = None
+    for _ in range(repeat):
+        tStart = time.time()
+        value = function()
+        times.append(time.time() - tStart)
+    record = {
+        'stage': name,
+        'repeat': repeat,
+        'items': items,
+        'best': min(times),
+        'median': float(np.median(times)),
+        'mean': float(np.mean(times)),
+        'bestPerItem': min(times)/max(items, 1)}
+    print >> sys.stderr, '%-16s best %9.4f s  median %9.4f s  (%d items)' % (name, record['best'], record['median'], items)
+    return record, value
+
+
+def runBenchmarks(trainCount=4, queryCount=4, repeat=3, words=2000, seed=0, workDir=None):
+    # Returns the benchmark report as a dict
+    ownDir = workDir is None
+    if ownDir:
+        workDir = tempfile.mkdtemp(prefix='clplogor-benchmark-')
+    sharedCache = feature_cache._sharedCache
+    try:
+        np.random.seed(seed)
+        trainPaths, queryPaths = generateImages(workDir, trainCount, queryCount, seed)
+        cache = feature_cache.FeatureCache(os.path.join(workDir, 'cache'))
+        stages = []
+
+        # SIFT, without the cache
+        images = [cv2.imread(path) for path in trainPaths + queryPaths]
+        record, features = timeStage('sift', lambda: [cache.compute(img) for img in images], repeat, len(images))
+        stages.append(record)
+        # training and recognition below read the features from this cache,
+        # the shared one is put back at the end
+        for path, (points, des) in zip(trainPaths + queryPaths, features):
+            cache.store(cache.cacheKey(path), points, des)
+        feature_cache._sharedCache = cache
+
+        # Training pair loop on a fresh handler each time
+        pairPaths = [(img1path, img2path) for img1path in trainPaths for img2path in trainPaths if img1path != img2path]
+        def trainPairs():
+            trHandler = TrainingHandler('benchmark', load_model=False)
+            trHandler.train_pairs(pairPaths)
+            return trHandler
+        record, trHandler = timeStage('training_pairs', trainPairs, repeat, len(pairPaths))
+        stages.append(record)
+
+        desArray = np.asarray(trHandler.trainedDescriptorsList, np.float32).reshape(-1, 128)
+        record, centroids = timeStage('kmeans', lambda: vocabulary.MiniBatchVocabulary(words, seed=seed).build(desArray), repeat, len(desArray))
+        stages.append(record)
+        trHandler.centroidsOfKmean2000 = centroids
+        trHandler.wordAssigner = vocabulary.VocabularyTree(centroids[0])
+        trHandler.visualWordLabelIDs = list(trHandler.wordAssigner.assign(desArray))
+
+        def buildIndexes():
+            trHandler.dVisualWordIndexCheck = edge_index.WordPairIndex(max(words, len(centroids[0])))
+            trHandler.edgeIndexHash = edge_index.EdgeIndex()
+            trHandler.trianglesIndexLSH = LSHash(32, 8, storage_config={'array': None})
+            trHandler.generate_EdgeandTriangle_LSH()
+        record, _ = timeStage('lsh_build', buildIndexes, repeat, len(trHandler.triangleVWwith6anglesFeatureList))
+        stages.append(record)
+
+        # Recognition stages over the query images
+        recognizer = Recognizer()
+        queries = [cache.detectAndCompute(path) + (path,) for path in queryPaths]
+        queries = [(kp, des, path) for kp, des, path in queries if des is not None]
+        queryDes = [np.asarray(des) for kp, des, path in queries]
+        descriptorCount = sum(len(des) for des in queryDes)
+
+        record, _ = timeStage('vq', lambda: [vq(des, centroids[0])[0] for des in queryDes], repeat, descriptorCount)
+        stages.append(record)
+        record, labels = timeStage('vocabulary_tree', lambda: [trHandler.wordAssigner.assign(des) for des in queryDes], repeat, descriptorCount)
+        stages.append(record)
+
+        record, pairs = timeStage('pairs', lambda: [recognizer.sampleEdges(kp) for kp, des, path in queries], repeat, len(queries))
+        stages.append(record)
+        pairCount = sum(len(pairI) for pairI, pairJ, alphas, betas in pairs)
+
+        def edgeFilter():
+            edges = []
+            for Ids, (pairI, pairJ, alphas, betas) in zip(labels, pairs):
+                ki = Ids[pairI]
+                kj = Ids[pairJ]
+                edgeMatch = trHandler.dVisualWordIndexCheck[ki, kj]
+                edgeMatch[edgeMatch] = trHandler.edgeIndexHash.containsNear(ki[edgeMatch], kj[edgeMatch],
+                    edge_index.angleBins(alphas[edgeMatch]), edge_index.angleBins(betas[edgeMatch]))
+                edges.append((pairI[edgeMatch], pairJ[edgeMatch]))
+            return edges
+        record, edges = timeStage('edge_filter', edgeFilter, repeat, pairCount)
+        stages.append(record)
+
+        def triangles():
+            queryTriangles = []
+            for (kp, des, path), Ids, (pairI, pairJ) in zip(queries, labels, edges):
+                tripePointNum = triangle_generator.enumerateTriangles(pairI, pairJ, len(kp))
+                queryTriangles.append(recognizer.createTriangles(tripePointNum, kp, Ids*1000, path))
+            return queryTriangles
+        record, queryTriangles = timeStage('triangles', triangles, repeat, sum(len(pairI) for pairI, pairJ in edges))
+        stages.append(record)
+
+        triangleCount = sum(len(t) for t in queryTriangles)
+        record, _ = timeStage('lsh_query', lambda: [recognizer.countTriangleMatches(t, trHandler) for t in queryTriangles], repeat, triangleCount)
+        stages.append(record)
+
+        return {
+            'version': BENCHMARK_FORMAT_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {'trainImages': trainCount, 'queryImages': queryCount, 'repeat': repeat, 'words': words, 'seed': seed},
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'scipy': scipy.__version__, 'cv2': cv2.__version__, 'machine': platform.machine()},
+            'counts': {'trainDescriptors': len(desArray), 'trainTriangles': len(trHandler.triangleVWwith6anglesFeatureList),
+                       'queryDescriptors': descriptorCount, 'queryPairs': pairCount, 'queryTriangles': triangleCount},
+            'stages': stages}
+    finally:
+        feature_cache._sharedCache = sharedCache
+        if ownDir:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stage timings on synthetic logo images')
+    parser.add_argument('--train', type=int, default=4, help='training images')
+    parser.add_argument('--query', type=int, default=4, help='query images')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every stage')
+    parser.add_argument('--words', type=int, default=2000, help='visual words')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file, stdout if not given')
+    args = parser.parse_args()
+
+    report = runBenchmarks(args.train, args.query, args.repeat, args.words, args.seed)
+    if args.output:
+        fh = open(args.output, 'w')
+        try:
+            json.dump(report, fh, indent=2, sort_keys=True)
+        finally:
+            fh.close()
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
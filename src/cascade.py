@@ -0,0 +1,70 @@
+import json
+
+# USAGE:
+#   main.validate(logo_classes)    # writes the thresholds of every class
+#   thresholds = cascade.loadThresholds('adidas')
+#   result = recognizer.recognize(imgpath, trHandler, thresholds)
+#   print result['decision'], result['matches']
+# Decisions are exact, rejects come only once every pair is sampled. With
+# Recognizer(cascadeEstimate=2) negatives are also rejected on an estimate
+# after part of the pairs, see Recognizer.matchCascade.
+
+
+class CascadeThresholds(object):
+    # Decision of one logo class on the triangle match count of an image: with
+    # at least accept matches the image shows the logo, with fewer than
+    # reject it does not, counts in between stay undecided (None).
+    def __init__(self, accept, reject=None):
+        if reject is None:
+            reject = accept
+        if reject > accept:
+            raise ValueError('reject threshold %d is above accept threshold %d' % (reject, accept))
+        self.accept = accept
+        self.reject = reject
+
+    def __repr__(self):
+        return 'CascadeThresholds(%d, %d)' % (self.accept, self.reject)
+
+    def decide(self, matches, upperBound):
+        # Decision once the final count lies in [matches, upperBound], None
+        # while it can still fall on either side
+        if matches >= self.accept:
+            return 'accept'
+        if upperBound < self.reject:
+            return 'reject'
+        return None
+
+    @classmethod
+    def fromCounts(cls, positives, negatives):
+        # Thresholds from the match counts of logo images and of images
+        # without the logo: accept above every negative, reject below every
+        # positive
+        if not positives and not negatives:
+            raise ValueError('no counts to derive thresholds from')
+        if negatives:
+            accept = max(negatives) + 1
+        else:
+            accept = min(positives)
+        reject = min(positives) if positives else 0
+        return cls(accept, min(reject, accept))
+
+
+# Summary of the last validation run, written by ValidationDriver.summarize
+SUMMARY_PATH = '../validation/valset.summary.json'
+
+def counterPath(logo_name):
+    # Counts written by ValidationDriver.writeCounter in main.validate
+    return '../triangleCounter/' + logo_name
+
+def loadThresholds(logo_name, summaryPath=SUMMARY_PATH):
+    # CascadeThresholds of a class as derived from its validation counts by
+    # ValidationDriver, which labels the images of the class as positives
+    fh = open(summaryPath, 'r')
+    try:
+        summary = json.load(fh)
+    finally:
+        fh.close()
+    if 'cascade' not in summary.get(logo_name, {}):
+        raise ValueError('%s has no cascade thresholds for %s' % (summaryPath, logo_name))
+    thresholds = summary[logo_name]['cascade']
+    return CascadeThresholds(thresholds['accept'], thresholds['reject'])
@@ -0,0 +1,197 @@
+import numpy as np
+
+# Edge angles are quantized into bins of this many degrees
+ANGLE_BIN = 24
+
+# (alphabin, betabin) offsets probed around an edge when recognizing
+NEIGHBOUR_BINS = [(0,0),(1,0),(0,1),(-1,0),(0,-1),(1,1),(-1,-1)]
+
+# Bit layout of a packed key: vi | vj | alphabin | betabin
+_BIN_BITS = 8
+_WORD_BITS = 24
+_BIN_OFFSET = 1 << (_BIN_BITS - 1)
+
+# Mask of bit (j & 7) inside a byte of np.packbits order
+_BIT_MASKS = np.array([128,64,32,16,8,4,2,1],np.uint8)
+
+
+def angleBins(angles):
+    # Same as int(angle)/24 for the positive angles used here
+    return np.asarray(angles,float).astype(np.int64) // ANGLE_BIN
+
+def packKeys(vi, vj, alphabin, betabin):
+    vi = np.asarray(vi,np.int64)
+    vj = np.asarray(vj,np.int64)
+    alphabin = np.asarray(alphabin,np.int64) + _BIN_OFFSET
+    betabin = np.asarray(betabin,np.int64) + _BIN_OFFSET
+    return (((vi << _WORD_BITS) | vj) << (2*_BIN_BITS)) | (alphabin << _BIN_BITS) | betabin
+
+
+class PackedKeySet(object):
+    # Set of int64 keys kept as a sorted array, membership of many keys is
+    # tested with one searchsorted.
+
+    def __init__(self, keys=None):
+        if keys is None:
+            keys = np.zeros(0,np.int64)
+        self.keys = np.unique(np.asarray(keys,np.int64))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _addKeys(self, keys):
+        self.keys = np.union1d(self.keys,np.asarray(keys,np.int64).ravel())
+
+    def _findKeys(self, keys):
+        # Position of every key in self.keys and whether it is there at all
+        keys = np.asarray(keys,np.int64)
+        if len(self.keys) == 0:
+            return np.zeros(keys.shape,np.intp),np.zeros(keys.shape,bool)
+        flat = keys.ravel()
+        pos = np.searchsorted(self.keys,flat)
+        pos[pos == len(self.keys)] = 0
+        return pos.reshape(keys.shape),(self.keys[pos] == flat).reshape(keys.shape)
+
+    def _containsKeys(self, keys):
+        return self._findKeys(keys)[1]
+
+    def toArrays(self):
+        return {'keys': self.keys}
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        # keys are already sorted and unique, they are used as they are so a
+        # memory-mapped array stays mapped
+        index = cls()
+        index.keys = arrays['keys']
+        return index
+
+
+class EdgeIndex(PackedKeySet):
+    # (vi,vj,alphabin,betabin) edges of the trained triangles
+
+    @classmethod
+    def fromTuples(cls, tuples):
+        # Converts the former dict keyed by (vi,vj,alphabin,betabin)
+        edges = np.asarray(list(tuples),np.int64).reshape(-1,4)
+        return cls(packKeys(edges[:,0],edges[:,1],edges[:,2],edges[:,3]))
+
+    def __contains__(self, edge):
+        return bool(self.contains(*[[x] for x in edge])[0])
+
+    def add(self, vi, vj, alphabin, betabin):
+        self._addKeys(packKeys(vi,vj,alphabin,betabin))
+
+    def contains(self, vi, vj, alphabin, betabin):
+        return self._containsKeys(packKeys(vi,vj,alphabin,betabin))
+
+    def containsNear(self, vi, vj, alphabin, betabin, neighbours=NEIGHBOUR_BINS):
+        # True where any of the neighbouring bins of an edge is in the index
+        alphabin = np.asarray(alphabin,np.int64)
+        betabin = np.asarray(betabin,np.int64)
+        found = np.zeros(alphabin.shape,bool)
+        for da,db in neighbours:
+            found |= self.contains(vi,vj,alphabin+da,betabin+db)
+        return found
+
+
+class ClassEdgeIndex(PackedKeySet):
+    # EdgeIndex shared by several logo classes, every edge carries a uint64
+    # bitmask of the classes it was trained in.
+
+    MAX_CLASSES = 64
+
+    def __init__(self, keys=None):
+        PackedKeySet.__init__(self,keys)
+        self.classMasks = np.zeros(len(self.keys),np.uint64)
+
+    def add(self, vi, vj, alphabin, betabin, classId):
+        if not 0 <= classId < self.MAX_CLASSES:
+            raise ValueError('class id must be in [0,%d)' % self.MAX_CLASSES)
+        keys = packKeys(vi,vj,alphabin,betabin).ravel()
+        allKeys = np.concatenate([self.keys,keys])
+        allMasks = np.concatenate([self.classMasks,np.full(len(keys),1 << classId,np.uint64)])
+        self.keys,inverse = np.unique(allKeys,return_inverse=True)
+        self.classMasks = np.zeros(len(self.keys),np.uint64)
+        np.bitwise_or.at(self.classMasks,inverse,allMasks)
+
+    def toArrays(self):
+        return {'keys': self.keys, 'classMasks': self.classMasks}
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        index = cls()
+        index.keys = arrays['keys']
+        index.classMasks = arrays['classMasks']
+        return index
+
+    def classesNear(self, vi, vj, alphabin, betabin, neighbours=NEIGHBOUR_BINS):
+        # Bitmask of the classes having any of the neighbouring bins of an edge
+        alphabin = np.asarray(alphabin,np.int64)
+        betabin = np.asarray(betabin,np.int64)
+        masks = np.zeros(alphabin.shape,np.uint64)
+        for da,db in neighbours:
+            pos,found = self._findKeys(packKeys(vi,vj,alphabin+da,betabin+db))
+            masks[found] |= self.classMasks[pos[found]]
+        return masks
+
+
+class WordPairIndex(object):
+    # Symmetric visual word co-occurrence, replaces the dense bool matrix.
+    # Every word has a row of bits packed eight to a byte, so the index takes
+    # words*words/8 bytes, an eighth of the matrix. Indexing works like the
+    # matrix did: index[vi,vj] with scalars or arrays, and index[vi,vj] = True
+    # to record pairs.
+
+    def __init__(self, words=2000):
+        self.words = words
+        self.bits = np.zeros((words,(words+7)//8),np.uint8)
+
+    @classmethod
+    def fromMatrix(cls, matrix):
+        # Converts the former dense (words,words) bool matrix
+        matrix = np.asarray(matrix,bool)
+        index = cls(matrix.shape[0])
+        index.bits = np.packbits(matrix,axis=1)
+        return index
+
+    def toArrays(self):
+        return {'bits': self.bits}
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        # copied, pairs are added in place. Files written before the rows
+        # were stored directly have the rows of the words in pairs only.
+        if 'bits' in arrays:
+            bits = np.array(arrays['bits'])
+        else:
+            bits = np.asarray(arrays['bitRows'])[np.asarray(arrays['rowOfWord'])]
+        index = cls(0)
+        index.words = len(bits)
+        index.bits = bits
+        return index
+
+    def __setstate__(self, state):
+        # pickles of the former layout share an empty row between words
+        if 'bitRows' in state:
+            state = {'words': state['words'], 'bits': state['bitRows'][state['rowOfWord']]}
+        self.__dict__.update(state)
+
+    def __getitem__(self, pair):
+        vi,vj = pair
+        vi = np.asarray(vi,np.intp)
+        vj = np.asarray(vj,np.intp)
+        found = (self.bits[vi,vj >> 3] & _BIT_MASKS[vj & 7]) != 0
+        if found.ndim == 0:
+            return bool(found)
+        return found
+
+    def __setitem__(self, pair, value):
+        if not value:
+            raise ValueError('pairs can only be added')
+        vi,vj = pair
+        vi = np.asarray(vi,np.intp).ravel()
+        vj = np.asarray(vj,np.intp).ravel()
+        # Both directions are recorded
+        vi,vj = np.concatenate([vi,vj]),np.concatenate([vj,vi])
+        np.bitwise_or.at(self.bits,(vi,vj >> 3),_BIT_MASKS[vj & 7])
@@ -0,0 +1,114 @@
+import cv2
+import numpy as np
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+# Bump when the detector or the stored layout changes, old entries are ignored
+CACHE_VERSION = 1
+
+class FeatureCache:
+    # SIFT keypoints and descriptors of image files, stored on disk under the
+    # hash of the file content and the detector parameters, with an in-memory
+    # LRU in front. Extracting the same image again becomes a cheap load.
+    # Safe to share between threads.
+    def __init__(self, cacheDirPath='../cache/features', maxMemoryEntries=256, detectorParams=None):
+        self.cacheDirPath = cacheDirPath
+        self.maxMemoryEntries = maxMemoryEntries
+        # passed to cv2.SIFT, part of the cache key
+        self.detectorParams = detectorParams or {}
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def cacheKey(self, imgpath):
+        h = hashlib.sha1()
+        with open(imgpath, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                h.update(chunk)
+        h.update(repr((CACHE_VERSION, sorted(self.detectorParams.items()))))
+        return h.hexdigest()
+
+    def cacheKeyOfData(self, data):
+        # same key as cacheKey for the content of a file
+        h = hashlib.sha1(data)
+        h.update(repr((CACHE_VERSION, sorted(self.detectorParams.items()))))
+        return h.hexdigest()
+
+    def detectAndCompute(self, imgpath):
+        key = self.cacheKey(imgpath)
+        found = self.lookup(key)
+        if found is not None:
+            return self.unpack(*found)
+        points, des = self.compute(cv2.imread(imgpath))
+        self.store(key, points, des)
+        return self.unpack(points, des)
+
+    def lookup(self, key):
+        # (points, descriptors) arrays of a cached entry or None
+        with self.lock:
+            if key in self.memory:
+                self.memory[key] = self.memory.pop(key)
+                return self.memory[key]
+        filePath = self._filePath(key)
+        if not os.path.isfile(filePath):
+            return None
+        data = np.load(filePath)
+        points, des = data['keypoints'], data['descriptors']
+        self._remember(key, points, des)
+        return points, des
+
+    def compute(self, img):
+        # SIFT of a decoded image as (points, descriptors) arrays
+        # Initiate SIFT detector
+        sift = cv2.SIFT(**self.detectorParams)
+        kp, des = sift.detectAndCompute(img,None)
+        points = np.array([[k.pt[0],k.pt[1],k.size,k.angle,k.response,k.octave,k.class_id] for k in kp],np.float32).reshape(-1,7)
+        des = np.asarray(des,np.float32).reshape(-1,128)
+        return points, des
+
+    def store(self, key, points, des):
+        self._write(self._filePath(key), points, des)
+        self._remember(key, points, des)
+
+    def _filePath(self, key):
+        return os.path.join(self.cacheDirPath, key[:2], key + '.npz')
+
+    def _remember(self, key, points, des):
+        with self.lock:
+            self.memory[key] = (points, des)
+            while len(self.memory) > self.maxMemoryEntries:
+                self.memory.popitem(last=False)
+
+    def _write(self, filePath, points, des):
+        # write to a temporary file first so readers never see a partial entry
+        dirPath = os.path.dirname(filePath)
+        if not os.path.isdir(dirPath):
+            try:
+                os.makedirs(dirPath)
+            except OSError:
+                if not os.path.isdir(dirPath):
+                    raise
+        tmpPath = '%s.%d.%d.tmp' % (filePath, os.getpid(), threading.current_thread().ident)
+        with open(tmpPath, 'wb') as fh:
+            np.savez(fh, keypoints=points, descriptors=des)
+        os.rename(tmpPath, filePath)
+
+    def unpack(self, points, des):
+        # cv2 keypoints and descriptors of (points, descriptors) arrays
+        kp = [cv2.KeyPoint(float(x),float(y),float(size),float(angle),float(response),int(octave),int(class_id))
+              for x,y,size,angle,response,octave,class_id in points]
+        if len(kp) == 0:
+            return kp, None
+        return kp, des
+
+_sharedCache = None
+_sharedCacheLock = threading.Lock()
+
+def sharedCache():
+    # Process-wide cache used by Recognizer and TrainingHandler
+    global _sharedCache
+    with _sharedCacheLock:
+        if _sharedCache is None:
+            _sharedCache = FeatureCache()
+    return _sharedCache
@@ -1,29 +1,50 @@
 import cPickle
+import os
+import model_format
 
 class FeatureStorage:
     def __init__(self, logo_tile):
         self.destDirPath = '../model'
         self.logo_tile = logo_tile
 
-    def save(self, data):
+    def modelPath(self, logo_tile = None):
+        # versioned array format, see model_format.py
+        if logo_tile == None:
+            logo_tile = self.logo_tile
+        return self.destDirPath + '/' + logo_tile + '.model'
 
-        logo_tile = self.logo_tile
+    def picklePath(self, logo_tile = None):
+        # former pickled tuple, still read to migrate old models
+        if logo_tile == None:
+            logo_tile = self.logo_tile
+        return self.destDirPath + '/' + logo_tile + '.pkl'
 
-        # store whole trHandler into ./model/logo_name.pkl
-        fh = open( self.destDirPath + '/' + logo_tile+'.pkl', 'wb')
+    def saveArrays(self, kind, arrays, meta):
+        model_format.writeModel(self.modelPath(), kind, arrays, meta)
 
+    def openArrays(self, logo_tile = None):
+        return model_format.ModelFile(self.modelPath(logo_tile))
 
-        cPickle.dump(data,fh)
+    def save(self, data):
 
-        if fh is not None:
+        # store whole trHandler into ./model/logo_name.pkl
+        # the pickle goes to a temporary file that is renamed over the model,
+        # a crash while saving never leaves a half-written model behind
+        path = self.picklePath()
+        tmpPath = '%s.%d.tmp' % (path, os.getpid())
+        fh = open(tmpPath, 'wb')
+        try:
+            cPickle.dump(data,fh)
+        finally:
             fh.close()
+        os.rename(tmpPath, path)
 
     def load(self, logo_tile = None):
         if logo_tile == None:
             # raise error
             logo_tile = self.logo_tile
 
-        fh = open(self.destDirPath + '/' + logo_tile+'.pkl', 'rb')
+        fh = open(self.picklePath(logo_tile), 'rb')
         data = cPickle.load(fh)
         fh.close()
 
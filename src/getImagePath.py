@@ -8,7 +8,8 @@ class GetImagePath(object):
         self.path = path
         self.arrayOfSet = [{}, {}, {}]
 
-    def getImagePath(self, className, setNum):
+    def loadSet(self, setNum):
+        # {className: image paths} of a set, read once
         setNum = setNum - 1
         if len(self.arrayOfSet[setNum]) < 1:
             pathOfSet = [self.path+'/trainset.txt', self.path+'/valset.txt', self.path+'/testset.txt']
@@ -24,7 +25,14 @@ class GetImagePath(object):
                 else:
                     self.arrayOfSet[setNum][lineSplit[0]] = [filePath]
             f.close()
+        return self.arrayOfSet[setNum]
+
+    def hasClass(self, className, setNum):
+        return className in self.loadSet(setNum)
 
+    def getImagePath(self, className, setNum):
+        self.loadSet(setNum)
+        setNum = setNum - 1
         if setNum >= 0 and setNum < 3:
             if className in self.arrayOfSet[setNum]:
                 return self.arrayOfSet[setNum][className]
@@ -0,0 +1,149 @@
+import json
+import time
+import threading
+
+# USAGE:
+#   aggregator = instrumentation.AggregatorSink()
+#   instrumentation.sharedInstrumentation().addSink(aggregator)
+#   instrumentation.sharedInstrumentation().addSink(instrumentation.JsonLinesSink('../log/calls.jsonl'))
+#   ... recognize / train ...
+#   print aggregator.snapshot()
+
+
+class CallRecord(object):
+    # Counters and stage timings of one call (one recognized image, one
+    # trained pair). Stages are timed as laps: lap(stage) charges the time
+    # since the previous lap, or since the record began, to stage.
+    enabled = True
+
+    def __init__(self, kind, name=None):
+        self.kind = kind
+        self.name = name
+        self.counters = {}
+        self.timings = {}
+        self.tStart = time.time()
+        self.tLap = self.tStart
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + int(n)
+
+    def lap(self, stage):
+        now = time.time()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self.tLap
+        self.tLap = now
+
+    def asDict(self):
+        return {'kind': self.kind, 'name': self.name, 'time': self.tStart,
+                'seconds': self.tLap - self.tStart,
+                'counters': dict(self.counters), 'timings': dict(self.timings)}
+
+
+class _NullRecord(CallRecord):
+    # The record of every call while instrumentation is disabled, counting
+    # and timing do nothing and finish drops it
+    enabled = False
+
+    def __init__(self):
+        CallRecord.__init__(self, None)
+
+    def count(self, counter, n=1):
+        pass
+
+    def lap(self, stage):
+        pass
+
+NULL_RECORD = _NullRecord()
+
+
+class Instrumentation(object):
+    # Hands call records to the sinks. Without sinks begin returns the shared
+    # NULL_RECORD, so disabled instrumentation costs an empty method call per
+    # stage and counter.
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self.lock = threading.Lock()
+
+    def addSink(self, sink):
+        with self.lock:
+            self.sinks = self.sinks + [sink]
+
+    def removeSink(self, sink):
+        with self.lock:
+            self.sinks = [s for s in self.sinks if s is not sink]
+
+    def begin(self, kind, name=None):
+        # A new CallRecord, or NULL_RECORD while disabled
+        if not self.sinks:
+            return NULL_RECORD
+        return CallRecord(kind, name)
+
+    def finish(self, record):
+        if not record.enabled:
+            return
+        data = record.asDict()
+        for sink in self.sinks:
+            sink.write(data)
+
+
+class JsonLinesSink:
+    # Appends every call record as one JSON line to a file
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        line = json.dumps(data, sort_keys=True) + '\n'
+        with self.lock:
+            self.fh.write(line)
+            self.fh.flush()
+
+    def close(self):
+        with self.lock:
+            self.fh.close()
+
+
+class AggregatorSink:
+    # Sums the counters and stage timings of the calls of every kind in memory
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # kind -> {'calls', 'seconds', 'maxSeconds', 'counters', 'timings'}
+            self.kinds = {}
+
+    def write(self, data):
+        with self.lock:
+            total = self.kinds.get(data['kind'])
+            if total is None:
+                total = self.kinds[data['kind']] = {'calls': 0, 'seconds': 0.0, 'maxSeconds': 0.0,
+                                                    'counters': {}, 'timings': {}}
+            total['calls'] += 1
+            total['seconds'] += data['seconds']
+            total['maxSeconds'] = max(total['maxSeconds'], data['seconds'])
+            for counter, n in data['counters'].iteritems():
+                total['counters'][counter] = total['counters'].get(counter, 0) + n
+            for stage, seconds in data['timings'].iteritems():
+                total['timings'][stage] = total['timings'].get(stage, 0.0) + seconds
+
+    def snapshot(self):
+        # The totals of every kind with the mean seconds per call added
+        with self.lock:
+            snapshot = {}
+            for kind, total in self.kinds.iteritems():
+                snapshot[kind] = dict(total, counters=dict(total['counters']), timings=dict(total['timings']),
+                                      meanSeconds=total['seconds']/total['calls'])
+            return snapshot
+
+_sharedInstrumentation = None
+_sharedInstrumentationLock = threading.Lock()
+
+def sharedInstrumentation():
+    # Process-wide instrumentation, disabled until a sink is added
+    global _sharedInstrumentation
+    with _sharedInstrumentationLock:
+        if _sharedInstrumentation is None:
+            _sharedInstrumentation = Instrumentation()
+    return _sharedInstrumentation
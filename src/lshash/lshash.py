@@ -6,14 +6,13 @@
 
 import os
 import json
+import heapq
 import numpy as np
 
 from storage import storage
 
-try:
-    from bitarray import bitarray
-except ImportError:
-    bitarray = None
+# (hash_size, num_probes) -> probe templates, see LSHash._probe_templates
+_probe_template_cache = {}
 
 
 class LSHash(object):
@@ -32,10 +31,12 @@ class LSHash(object):
         (optional) The number of hash tables used for multiple lookups.
     :param storage_config:
         (optional) A dictionary of the form `{backend_name: config}` where
-        `backend_name` is the either `dict` or `redis`, and `config` is the
-        configuration used by the backend. For `redis` it should be in the
-        format of `{"redis": {"host": hostname, "port": port_num}}`, where
-        `hostname` is normally `localhost` and `port` is normally 6379.
+        `backend_name` is either `dict`, `array` or `redis`, and `config` is
+        the configuration used by the backend. `array` keeps the points in
+        one float32 matrix and ranks candidates without building them as
+        tuples, it needs a `hash_size` of at most 64. For `redis` it should be
+        in the format of `{"redis": {"host": hostname, "port": port_num}}`,
+        where `hostname` is normally `localhost` and `port` is normally 6379.
     :param matrices_filename:
         (optional) Specify the path to the compressed numpy file ending with
         extension `.npz`, where the uniform random planes are stored, or to be
@@ -117,8 +118,22 @@ class LSHash(object):
 
         return np.random.randn(self.hash_size, self.input_dim)
 
+    def __setstate__(self, state):
+        """ Restores a pickled instance. Tables pickled before hashes were
+        packed into integers are keyed by '0'/'1' strings, those keys are
+        converted so old models can still be queried.
+        """
+
+        self.__dict__.update(state)
+        for table in self.hash_tables:
+            if table.name == 'dict':
+                table.storage = dict(
+                    (int(key, 2) if isinstance(key, basestring) else key, val)
+                    for key, val in table.storage.iteritems())
+
     def _hash(self, planes, input_point):
-        """ Generates the binary hash for `input_point` and returns it.
+        """ Generates the binary hash for `input_point` and returns it packed
+        into an integer, the first plane being the most significant bit.
 
         :param planes:
             The planes are random uniform planes with a dimension of
@@ -128,9 +143,25 @@ class LSHash(object):
             The dimension needs to be 1 * `input_dim`.
         """
 
+        return self._hash_batch(planes, [input_point])[0]
+
+    def _project_batch(self, planes, input_points):
+        """ Projects every row of `input_points` on the planes with a single
+        matrix product, the signs of the n * `hash_size` result are the hash
+        bits and its magnitudes the margins of the bits.
+
+        :param planes:
+            The planes are random uniform planes with a dimension of
+            `hash_size` * `input_dim`.
+        :param input_points:
+            A 2D array-like object of numbers with a dimension of
+            n * `input_dim`.
+        """
+
         try:
-            input_point = np.array(input_point)  # for faster dot product
-            projections = np.dot(planes, input_point)
+            input_points = np.asarray(input_points, dtype=float).reshape(
+                -1, self.input_dim)
+            return np.dot(input_points, planes.T)
         except TypeError as e:
             print("""The input point needs to be an array-like object with
                   numbers only elements""")
@@ -139,8 +170,85 @@ class LSHash(object):
             print("""The input point needs to be of the same dimension as
                   `input_dim` when initializing this LSHash instance""", e)
             raise
-        else:
-            return "".join(['1' if i > 0 else '0' for i in projections])
+
+    def _hash_batch(self, planes, input_points):
+        """ Generates the binary hashes of every row of `input_points` with a
+        single matrix product and returns them as a list of packed integers.
+
+        :param planes:
+            The planes are random uniform planes with a dimension of
+            `hash_size` * `input_dim`.
+        :param input_points:
+            A 2D array-like object of numbers with a dimension of
+            n * `input_dim`.
+        """
+
+        return self._pack_bits(
+            self._project_batch(planes, input_points) > 0).tolist()
+
+    def _probe_templates(self, num_probes, hamming=False):
+        """ The bit sets flipped by multi-probe LSH (Lv et al., Multi-Probe
+        LSH, VLDB 2007) as tuples of margin ranks, rank 0 being the bit whose
+        projection lies closest to its plane. The sets are ordered by their
+        expected score, the sum of the expected squared margins of their
+        ranks, and the empty set (the exact bucket) comes first. With
+        `hamming` the sets are the exact bucket and every single bit.
+        """
+
+        if hamming:
+            return [()] + [(rank,) for rank in xrange(self.hash_size)]
+        key = (self.hash_size, num_probes)
+        if key not in _probe_template_cache:
+            # expected squared margin of the rank-th smallest margin
+            scores = [((rank + 1.0) / (self.hash_size + 1)) ** 2
+                      for rank in xrange(self.hash_size)]
+            templates = [()]
+            heap = [(scores[0], (0,))]
+            while heap and len(templates) < num_probes:
+                score, ranks = heapq.heappop(heap)
+                templates.append(ranks)
+                last = ranks[-1]
+                if last + 1 < self.hash_size:
+                    # shift the highest rank up, or add the next one
+                    heapq.heappush(heap, (score - scores[last] +
+                                          scores[last + 1],
+                                          ranks[:-1] + (last + 1,)))
+                    heapq.heappush(heap, (score + scores[last + 1],
+                                          ranks + (last + 1,)))
+            _probe_template_cache[key] = templates
+        return _probe_template_cache[key]
+
+    def _probe_keys(self, projections, templates):
+        """ Returns the n * len(`templates`) packed hashes of the buckets to
+        probe for the rows of `projections`, a template flips the bits of
+        its margin ranks in the hash of the row.
+        """
+
+        n = len(projections)
+        order = np.argsort(np.abs(projections), axis=1)
+        flipped = np.zeros((n, len(templates), self.hash_size), dtype=bool)
+        rows = np.arange(n)
+        for t, ranks in enumerate(templates):
+            for rank in ranks:
+                flipped[rows, t, order[:, rank]] = True
+        masks = self._pack_bits(flipped.reshape(-1, self.hash_size)).reshape(
+            n, len(templates))
+        hashes = self._pack_bits(projections > 0)
+        return hashes[:, np.newaxis] ^ masks
+
+    def _pack_bits(self, bits):
+        """ Packs the rows of the boolean matrix `bits` into integers, using
+        uint64 when they fit and Python longs otherwise.
+        """
+
+        hash_size = bits.shape[1]
+        if hash_size <= 64:
+            weights = np.left_shift(np.uint64(1), np.arange(
+                hash_size - 1, -1, -1, dtype=np.uint64))
+            return np.dot(bits.astype(np.uint64), weights)
+        weights = np.array([1 << b for b in xrange(hash_size - 1, -1, -1)],
+                           dtype=object)
+        return np.dot(bits.astype(object), weights)
 
     def _as_np_array(self, json_or_tuple):
         """ Takes either a JSON-serialized data structure or a tuple that has
@@ -204,7 +312,41 @@ class LSHash(object):
             table.append_val(self._hash(self.uniform_planes[i], input_point),
                              value)
 
-    def query(self, query_point, num_results=None, distance_func=None):
+    def index_batch(self, input_points, extra_data=None):
+        """ Index every row of `input_points`, hashing them all at once.
+
+        :param input_points:
+            A 2D array-like object of numbers with a dimension of
+            n * `input_dim`.
+        :param extra_data:
+            (optional) A list of n values, the i-th one is stored with the
+            i-th point as in :meth:`.index`.
+        """
+
+        input_points = np.asarray(input_points, dtype=float).reshape(
+            -1, self.input_dim)
+        if extra_data is None:
+            extra_data = [None] * len(input_points)
+        elif len(extra_data) != len(input_points):
+            raise ValueError("extra_data needs one value per input point")
+
+        if all(table.name == 'array' for table in self.hash_tables):
+            values = None
+        else:
+            values = [(tuple(point), extra) if extra else tuple(point)
+                      for point, extra in zip(input_points.tolist(),
+                                              extra_data)]
+
+        for i, table in enumerate(self.hash_tables):
+            hashes = self._hash_batch(self.uniform_planes[i], input_points)
+            if table.name == 'array':
+                table.append_batch(hashes, input_points, extra_data)
+                continue
+            for binary_hash, value in zip(hashes, values):
+                table.append_val(binary_hash, value)
+
+    def query(self, query_point, num_results=None, distance_func=None,
+              num_probes=1):
         """ Takes `query_point` which is either a tuple or a list of numbers,
         returns `num_results` of results as a list of tuples that are ranked
         based on the supplied metric function `distance_func`.
@@ -221,7 +363,12 @@ class LSHash(object):
             (optional) The distance function to be used. Currently it needs to
             be one of ("hamming", "euclidean", "true_euclidean",
             "centred_euclidean", "cosine", "l1norm"). By default "euclidean"
-            will used.
+            will used. "hamming" takes the candidates of every bucket whose
+            hash differs in at most one bit, ranked by "euclidean".
+        :param num_probes:
+            (optional) The number of buckets looked up in each table, the
+            exact bucket and then the nearby ones in the order of
+            :meth:`._probe_templates`. More probes find more candidates.
         """
 
         candidates = set()
@@ -229,36 +376,17 @@ class LSHash(object):
             distance_func = "euclidean"
 
         if distance_func == "hamming":
-            if not bitarray:
-                raise ImportError(" Bitarray is required for hamming distance")
-
-            for i, table in enumerate(self.hash_tables):
-                binary_hash = self._hash(self.uniform_planes[i], query_point)
-                for key in table.keys():
-                    distance = LSHash.hamming_dist(key, binary_hash)
-                    if distance < 2:
-                        candidates.update(table.get_list(key))
-
+            templates = self._probe_templates(self.hash_size + 1, True)
             d_func = LSHash.euclidean_dist_square
-
         else:
+            templates = self._probe_templates(num_probes)
+            d_func = self._distance_func(distance_func)
 
-            if distance_func == "euclidean":
-                d_func = LSHash.euclidean_dist_square
-            elif distance_func == "true_euclidean":
-                d_func = LSHash.euclidean_dist
-            elif distance_func == "centred_euclidean":
-                d_func = LSHash.euclidean_dist_centred
-            elif distance_func == "cosine":
-                d_func = LSHash.cosine_dist
-            elif distance_func == "l1norm":
-                d_func = LSHash.l1norm_dist
-            else:
-                raise ValueError("The distance function name is invalid.")
-
-            for i, table in enumerate(self.hash_tables):
-                binary_hash = self._hash(self.uniform_planes[i], query_point)
-                candidates.update(table.get_list(binary_hash))
+        for i, table in enumerate(self.hash_tables):
+            projections = self._project_batch(self.uniform_planes[i],
+                                              [query_point])
+            for key in self._probe_keys(projections, templates)[0].tolist():
+                candidates.update(table.get_list(key))
 
         # rank candidates by distance function
         candidates = [(ix, d_func(query_point, self._as_np_array(ix)))
@@ -267,12 +395,193 @@ class LSHash(object):
 
         return candidates[:num_results] if num_results else candidates
 
+    def query_batch(self, query_points, num_results=None,
+                    distance_func=None, group_func=None, stats=None,
+                    num_probes=1):
+        """ Batch version of :meth:`.query`. Returns one ranked result list per
+        row of `query_points`, each in the same format as :meth:`.query`.
+
+        All rows are hashed with one matrix product. Rows that probe the
+        same buckets share one candidate matrix, which is ranked for all of
+        them at once. With `array` storage the candidate matrix is gathered
+        from the stored rows and only the returned values are built.
+
+        :param query_points:
+            A 2D array-like object of numbers with a dimension of
+            n * `input_dim`.
+        :param num_results:
+            (optional) Integer, specifies the max amount of results to be
+            returned for each row.
+        :param distance_func:
+            (optional) Same as for :meth:`.query`.
+        :param group_func:
+            (optional) A function mapping a stored value (as returned in the
+            results) to a hashable group. If given, `num_results` applies to
+            each group separately, e.g. the nearest candidate of every group
+            is returned with `num_results=1`.
+        :param stats:
+            (optional) A dict, the number of candidates ranked over all rows
+            is added to its "candidates" entry.
+        :param num_probes:
+            (optional) Same as for :meth:`.query`.
+        """
+
+        if not distance_func:
+            distance_func = "euclidean"
+        if distance_func == "hamming":
+            templates = self._probe_templates(self.hash_size + 1, True)
+            d_func = LSHash.euclidean_dist_square_batch
+        else:
+            templates = self._probe_templates(num_probes)
+            d_func = self._distance_func(distance_func, batch=True)
+
+        query_points = np.asarray(query_points, dtype=float).reshape(
+            -1, self.input_dim)
+        probes = [self._probe_keys(self._project_batch(self.uniform_planes[i],
+                                                       query_points),
+                                   templates).tolist()
+                  for i in xrange(self.num_hashtables)]
+
+        groups = {}
+        for row, keys in enumerate(zip(*probes)):
+            groups.setdefault(tuple(tuple(sorted(set(table_keys)))
+                                    for table_keys in keys), []).append(row)
+
+        if all(table.name == 'array' for table in self.hash_tables):
+            gather = self._array_candidates
+        else:
+            gather = self._stored_candidates
+
+        results = [[] for _ in xrange(len(query_points))]
+        for keys, rows in groups.iteritems():
+            candidates, points, group_of = gather(keys, group_func)
+            if not len(candidates):
+                continue
+
+            if stats is not None:
+                stats["candidates"] = stats.get("candidates", 0) + \
+                    len(candidates) * len(rows)
+            # bound the rows * candidates * input_dim temporaries
+            step = max(1, (1 << 22) // (len(candidates) * self.input_dim))
+            for start in xrange(0, len(rows), step):
+                chunk = rows[start:start + step]
+                distances = d_func(query_points[chunk], points)
+                if num_results == 1 and not group_func:
+                    # argmin takes the first of equal distances, as the
+                    # stable sort does
+                    for row, dist, o in zip(chunk, distances,
+                                            np.argmin(distances, axis=1)):
+                        results[row] = [(candidates[o], dist[o])]
+                    continue
+                for row, dist in zip(chunk, distances):
+                    order = np.argsort(dist, kind='mergesort')
+                    if num_results and group_func:
+                        order = self._first_of_groups(order, group_of[order],
+                                                      num_results)
+                    elif num_results:
+                        order = order[:num_results]
+                    results[row] = [(candidates[o], dist[o]) for o in order]
+
+        return results
+
+    def _stored_candidates(self, keys, group_func):
+        """ The distinct values stored in the buckets `keys`, one tuple of
+        hashes per table, with the matrix of their points and, with
+        `group_func`, the group index of each.
+        """
+
+        candidates = set()
+        for table, table_keys in zip(self.hash_tables, keys):
+            for binary_hash in table_keys:
+                candidates.update(table.get_list(binary_hash))
+        candidates = list(candidates)
+        points = np.array([self._as_np_array(ix) for ix in candidates],
+                          dtype=float)
+        group_of = None
+        if group_func:
+            group_ids = {}
+            group_of = np.array([group_ids.setdefault(group_func(ix),
+                                                      len(group_ids))
+                                 for ix in candidates])
+        return candidates, points, group_of
+
+    def _array_candidates(self, keys, group_func):
+        """ Same as :meth:`._stored_candidates` for `array` tables. The
+        points are sliced from the tables and the candidates are a sequence
+        that builds each value when it is indexed. A point found in several
+        tables is kept once.
+        """
+
+        found = [(table, table.bucket_rows(table_keys))
+                 for table, table_keys in zip(self.hash_tables, keys)]
+        found = [(table, table_rows) for table, table_rows in found
+                 if len(table_rows)]
+        if not found:
+            return [], None, None
+        tables = np.concatenate([np.full(len(table_rows), i, dtype=np.intp)
+                                 for i, (_, table_rows) in enumerate(found)])
+        rows = np.concatenate([table_rows for _, table_rows in found])
+        points = np.concatenate([table.points[table_rows]
+                                 for table, table_rows in found])
+        group_of = None
+        if group_func:
+            group_ids = {}
+            group_of = []
+            for table, table_rows in found:
+                table_groups, names = table.groups(group_func, table_rows)
+                index = np.array([group_ids.setdefault(name, len(group_ids))
+                                  for name in names], dtype=np.intp)
+                group_of.append(index[table_groups])
+            group_of = np.concatenate(group_of)
+        if len(found) > 1:
+            ids = np.concatenate([table.ids[table_rows]
+                                  for table, table_rows in found])
+            first = np.sort(np.unique(ids, return_index=True)[1])
+            tables, rows, points = tables[first], rows[first], points[first]
+            if group_of is not None:
+                group_of = group_of[first]
+        return _ArrayCandidates([table for table, _ in found], tables,
+                                rows), points, group_of
+
+    @staticmethod
+    def _first_of_groups(order, groups, num_results):
+        """ Keeps the first `num_results` entries of every group in the ranked
+        index array `order`, `groups` holds the group of each entry.
+        """
+
+        by_group = np.argsort(groups, kind='mergesort')
+        sorted_groups = groups[by_group]
+        starts = np.searchsorted(sorted_groups, sorted_groups)
+        rank = np.empty(len(order), dtype=np.intp)
+        rank[by_group] = np.arange(len(order)) - starts
+        return order[rank < num_results]
+
+    def _distance_func(self, distance_func, batch=False):
+        """ Returns the distance function named `distance_func`. With `batch`
+        the function takes an n * `input_dim` matrix of query points and an
+        m * `input_dim` matrix of candidates and returns an n * m matrix.
+        """
+
+        names = {
+            "euclidean": (LSHash.euclidean_dist_square,
+                          LSHash.euclidean_dist_square_batch),
+            "true_euclidean": (LSHash.euclidean_dist,
+                               LSHash.euclidean_dist_batch),
+            "centred_euclidean": (LSHash.euclidean_dist_centred,
+                                  LSHash.euclidean_dist_centred_batch),
+            "cosine": (LSHash.cosine_dist, LSHash.cosine_dist_batch),
+            "l1norm": (LSHash.l1norm_dist, LSHash.l1norm_dist_batch),
+        }
+        if distance_func not in names:
+            raise ValueError("The distance function name is invalid.")
+        return names[distance_func][1 if batch else 0]
+
     ### distance functions
 
     @staticmethod
-    def hamming_dist(bitarray1, bitarray2):
-        xor_result = bitarray(bitarray1) ^ bitarray(bitarray2)
-        return xor_result.count()
+    def hamming_dist(hash1, hash2):
+        """ Number of differing bits between two packed integer hashes. """
+        return bin(int(hash1) ^ int(hash2)).count('1')
 
     @staticmethod
     def euclidean_dist(x, y):
@@ -299,3 +608,46 @@ class LSHash(object):
     @staticmethod
     def cosine_dist(x, y):
         return 1 - np.dot(x, y) / ((np.dot(x, x) * np.dot(y, y)) ** 0.5)
+
+    ### batch distance functions, query rows against candidate rows
+
+    @staticmethod
+    def euclidean_dist_batch(X, Y):
+        return np.sqrt(LSHash.euclidean_dist_square_batch(X, Y))
+
+    @staticmethod
+    def euclidean_dist_square_batch(X, Y):
+        diff = X[:, np.newaxis, :] - Y[np.newaxis, :, :]
+        return np.einsum('ijk,ijk->ij', diff, diff)
+
+    @staticmethod
+    def euclidean_dist_centred_batch(X, Y):
+        diff = np.mean(X, axis=1)[:, np.newaxis] - np.mean(Y, axis=1)
+        return diff * diff
+
+    @staticmethod
+    def l1norm_dist_batch(X, Y):
+        return np.abs(X[:, np.newaxis, :] - Y[np.newaxis, :, :]).sum(axis=2)
+
+    @staticmethod
+    def cosine_dist_batch(X, Y):
+        norms = np.sqrt(np.einsum('ij,ij->i', X, X)[:, np.newaxis] *
+                        np.einsum('ij,ij->i', Y, Y))
+        return 1 - np.dot(X, Y.T) / norms
+
+
+class _ArrayCandidates(object):
+    """ Candidates gathered from `array` tables, the i-th one is row
+    `rows[i]` of table `tables[i]`, its value is built when it is indexed.
+    """
+
+    def __init__(self, hash_tables, tables, rows):
+        self.hash_tables = hash_tables
+        self.tables = tables
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return self.hash_tables[self.tables[i]].value(self.rows[i])
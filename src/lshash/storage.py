@@ -5,6 +5,8 @@
 # the MIT License: http://www.opensource.org/licenses/mit-license.php
 
 import json
+import threading
+import numpy as np
 
 try:
     import redis
@@ -20,11 +22,13 @@ def storage(storage_config, index):
     """
     if 'dict' in storage_config:
         return InMemoryStorage(storage_config['dict'])
+    elif 'array' in storage_config:
+        return ArrayStorage(storage_config['array'])
     elif 'redis' in storage_config:
         storage_config['redis']['db'] = index
         return RedisStorage(storage_config['redis'])
     else:
-        raise ValueError("Only in-memory dictionary and Redis are supported.")
+        raise ValueError("Only in-memory dictionary, array and Redis are supported.")
 
 
 class BaseStorage(object):
@@ -82,6 +86,176 @@ class InMemoryStorage(BaseStorage):
         return self.storage.get(key, [])
 
 
+class ArrayStorage(BaseStorage):
+    """ In-memory storage that keeps all points in one float32 matrix in the
+    order of their bucket keys, with the buckets as CSR offsets into it, so a
+    bucket is a slice of rows. `ids` numbers the points in the order they
+    were indexed, a point has the same id in every table. Appended points
+    are merged into the arrays when the table is next read.
+    """
+
+    def __init__(self, config):
+        self.name = 'array'
+        # sorted bucket keys, bucket k holds rows offsets[k]:offsets[k+1]
+        self.bucket_keys = np.zeros(0, dtype=np.uint64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.points = None
+        self.ids = np.zeros(0, dtype=np.int64)
+        # the extra data of every row, None without
+        self.extras = []
+        self.next_id = 0
+        self._pending = []
+        self._groups = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_arrays(cls, keys, offsets, points, extras, ids=None):
+        """ A table of CSR arrays as written by the model format. `extras`
+        is any sequence of the extra data of the rows.
+        """
+
+        table = cls(None)
+        table.bucket_keys = np.asarray(keys).astype(np.uint64)
+        table.offsets = np.asarray(offsets, dtype=np.int64)
+        table.points = points
+        table.extras = extras
+        if ids is None:
+            ids = np.arange(len(points), dtype=np.int64)
+        table.ids = ids
+        table.next_id = int(ids.max()) + 1 if len(ids) else 0
+        return table
+
+    def __getstate__(self):
+        self._compact()
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_groups'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _compact(self):
+        """ Merges the appended points into the arrays, points of the same
+        bucket stay in the order they were stored.
+        """
+
+        with self._lock:
+            if not self._pending:
+                return
+            counts = np.diff(self.offsets)
+            keys = [np.repeat(self.bucket_keys, counts)]
+            points = [] if self.points is None else [self.points]
+            ids = [self.ids]
+            extras = list(self.extras)
+            for batch_keys, batch_points, batch_ids, batch_extras in \
+                    self._pending:
+                keys.append(batch_keys)
+                points.append(batch_points)
+                ids.append(batch_ids)
+                extras.extend(batch_extras)
+            keys = np.concatenate(keys)
+            order = np.argsort(keys, kind='mergesort')
+            keys = keys[order]
+            self.bucket_keys, counts = np.unique(keys, return_counts=True)
+            self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(
+                np.int64)
+            self.points = np.concatenate(points)[order]
+            self.ids = np.concatenate(ids)[order]
+            self.extras = [extras[row] for row in order.tolist()]
+            self._pending = []
+            self._groups = None
+
+    def keys(self):
+        self._compact()
+        return self.bucket_keys.tolist()
+
+    def set_val(self, key, val):
+        raise NotImplementedError("array storage only appends values")
+
+    def get_val(self, key):
+        return self.get_list(key)
+
+    def append_val(self, key, val):
+        if isinstance(val[0], tuple):
+            point, extra = val
+        else:
+            point, extra = val, None
+        self.append_batch([key], [point], [extra])
+
+    def append_batch(self, keys, points, extras):
+        """ Appends the rows of `points` with their keys and extra data. """
+
+        points = np.asarray(points, dtype=np.float32).reshape(len(keys), -1)
+        with self._lock:
+            ids = np.arange(self.next_id, self.next_id + len(keys),
+                            dtype=np.int64)
+            self.next_id += len(keys)
+            self._pending.append((np.asarray(keys, dtype=np.uint64), points,
+                                  ids, list(extras)))
+
+    def get_list(self, key):
+        return [self.value(row) for row in self.bucket_rows([key]).tolist()]
+
+    def bucket_rows(self, keys):
+        """ The rows of the buckets `keys` as one index array. """
+
+        self._compact()
+        keys = np.asarray(keys, dtype=np.uint64)
+        if len(self.bucket_keys) == 0 or len(keys) == 0:
+            return np.zeros(0, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.bucket_keys, keys),
+                         len(self.bucket_keys) - 1)
+        pos = np.unique(pos[self.bucket_keys[pos] == keys])
+        starts = self.offsets[pos]
+        lengths = self.offsets[pos + 1] - starts
+        ends = np.cumsum(lengths)
+        return np.repeat(starts - ends + lengths, lengths) + \
+            np.arange(ends[-1] if len(ends) else 0)
+
+    def value(self, row):
+        """ The stored value of a row, as it was given to `append_val`. """
+
+        point = tuple(self.points[row].tolist())
+        extra = self.extras[row]
+        return (point, extra) if extra else point
+
+    def groups(self, group_func, rows):
+        """ The group of each of `rows` as an index into the returned list of
+        groups, `group_func` maps a value to its group. When the same
+        function object is passed again the groups of all rows are computed
+        and kept for the following calls.
+        """
+
+        self._compact()
+        cached = self._groups
+        if cached is None or cached[0] is not group_func:
+            self._groups = (group_func, None, None)
+            return self._group_rows(group_func, rows)
+        if cached[1] is None:
+            index, names = self._group_rows(group_func,
+                                            np.arange(len(self.ids)))
+            cached = self._groups = (group_func, index, names)
+        return cached[1][rows], cached[2]
+
+    def _group_rows(self, group_func, rows):
+        group_ids = {}
+        index = np.array([group_ids.setdefault(group_func(self.value(row)),
+                                               len(group_ids))
+                          for row in rows.tolist()], dtype=np.intp)
+        return index, sorted(group_ids, key=group_ids.get)
+
+    def nbytes(self):
+        self._compact()
+        extras = getattr(self.extras, 'nbytes', None)
+        if extras is None:
+            extras = len(self.extras) * 64
+        points = 0 if self.points is None else self.points.nbytes
+        return (points + self.bucket_keys.nbytes + self.offsets.nbytes +
+                self.ids.nbytes + extras)
+
+
 class RedisStorage(BaseStorage):
     def __init__(self, config):
         if not redis:
@@ -90,7 +264,8 @@ class RedisStorage(BaseStorage):
         self.storage = redis.StrictRedis(**config)
 
     def keys(self, pattern="*"):
-        return self.storage.keys(pattern)
+        # hashes are packed integers, Redis hands them back as strings
+        return [int(key) for key in self.storage.keys(pattern)]
 
     def set_val(self, key, val):
         self.storage.set(key, val)
@@ -1,50 +1,44 @@
 import os
 from getImagePath import GetImagePath
 from training_handler import TrainingHandler
-from recognizer import Recognizer
+from multi_logo_model import MultiLogoModel
+from training_driver import TrainingDriver
+from validation_driver import ValidationDriver
+from feature_storage import FeatureStorage
 
-def train(logo_classes):
+def train(logo_classes, workers=None, memoryLimitMB=None):
 
-    # get training dataset and train model for each class
-    for logo_name in logo_classes:
-        if 'no-logo' in logo_name:
-            continue
-        else:
-            print 'Logo:', logo_name
-            trainingPaths = getImagePath.getImagePath(logo_name,1)
-            print trainingPaths
-
-            trHandler = TrainingHandler(logo_name)
-            trHandler.training_imageSet(trainingPaths)
-
-def validate(logo_classes):
-
-
-    # in order to get the threshold of each class
-    # we need to check number of match triangle in same logo class images
-    # and no-logo images.
+    # get training dataset and train model for each class, classes are
+    # trained concurrently and skipped when their model is up to date
+    logo_classes = [logo_name for logo_name in logo_classes if not 'no-logo' in logo_name]
+    driver = TrainingDriver(getImagePath, workers, memoryLimitMB)
+    driver.train(logo_classes)
 
-    for logo_name in logo_classes[:1]:
-        print logo_name
-        recognizer = Recognizer()
+def combine(logo_classes):
 
-        if 'no-logo' in logo_name:
-            continue
-        else:
-            trHandler = TrainingHandler(logo_name)
-            imgPaths = getImagePath.getImagePath(logo_name,2)
+    # build one model with a shared vocabulary from the trained class models,
+    # so Recognizer.recognizeAll checks an image against every class at once
+    trHandlers = [TrainingHandler(logo_name) for logo_name in logo_classes if not 'no-logo' in logo_name]
+    model = MultiLogoModel('all')
+    model.build(trHandlers)
 
-            for imgPath in imgPaths[:1]:
-                print imgPath
-                recognizer.recognize(imgPath, trHandler)
+def migrate(logo_classes):
 
-            nologoImgPaths = getImagePath.getImagePath('no-logo',2)
+    # rewrite models pickled by earlier versions in the array format
+    for logo_name in logo_classes:
+        FS = FeatureStorage(logo_name)
+        if os.path.isfile(FS.picklePath()) and not os.path.isfile(FS.modelPath()):
+            print 'Logo:', logo_name
+            TrainingHandler(logo_name).save_model()
 
-            for imgPath in nologoImgPaths[:1]:
-                print imgPath
-                recognizer.recognize(imgPath, trHandler)
+def validate(logo_classes, workers=None):
 
-            recognizer.writeImgTriangleCounter(logo_name)
+    # in order to get the threshold of each class
+    # we need to check number of match triangle in same logo class images
+    # and no-logo images. Every valset image is matched against every class
+    # in a process pool, an interrupted run resumes from its checkpoint.
+    driver = ValidationDriver(getImagePath, workers)
+    driver.validate(logo_classes)
 
 if __name__=='__main__':
 
@@ -57,6 +51,8 @@ if __name__=='__main__':
 
     getImagePath = GetImagePath(flickr_db_path)
 
+    #migrate(logo_classes)
     #train(logo_classes)
+    #combine(logo_classes)
     validate(logo_classes)
 
@@ -1,4 +1,5 @@
 import cv2
+import numpy as np
 from math import atan, degrees
 
 # FLANN parameters
@@ -36,5 +37,37 @@ def computeRelativeAngle(siftangle, vx, vy):
         rangle = 360 - (angle - (360.0 - siftangle))
     return rangle
 
+def computeRelativeAngles(siftangles, vx, vy):
+    # Batch version of computeRelativeAngle, siftangles/vx/vy are arrays of the
+    # same shape. The branches follow the scalar ladder exactly so results are
+    # identical, including on the axes.
+    siftangles = np.asarray(siftangles,float)
+    vx = np.asarray(vx,float)
+    vy = np.asarray(vy,float)
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        conditions = [
+            (vx > 0) & (vy >= 0),
+            (vx == 0) & (vy == 0),
+            (vx == 0) & (vy > 0),
+            (vx < 0) & (vy > 0),
+            (vx < 0) & (vy == 0),
+            (vx < 0) & (vy < 0),
+            (vx == 0) & (vy < 0),
+            (vx > 0) & (vy < 0)]
+        choices = [
+            np.degrees(np.arctan(vy/vx)),
+            0.0,
+            90.0,
+            90.0 + np.degrees(np.arctan(-vx/vy)),
+            180.0,
+            180.0 + np.degrees(np.arctan(vy/vx)),
+            270.0,
+            270.0 + np.degrees(np.arctan(vx/-vy))]
+        angle = np.select(conditions,choices,0.0)
+
+    reverse = 360.0 - siftangles
+    return np.where(reverse > angle, reverse - angle, 360.0 - (angle - reverse))
+
 def dictCode(a,b,max=180):
     return (int(a)/2+1)*max-(max-(int(b)/2+1))
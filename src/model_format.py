@@ -0,0 +1,192 @@
+import json
+import os
+import struct
+import numpy as np
+
+from lshash import LSHash
+from lshash.storage import ArrayStorage
+
+# On-disk model: the magic, the header length as uint32, a JSON header, then
+# raw arrays each starting at a multiple of _ALIGN. The header holds the
+# format version, the kind of model, plain metadata and the dtype, shape and
+# offset of every array, so an array can be memory-mapped without reading
+# anything else.
+MODEL_MAGIC = 'CLPLOGOR'
+# 2: WordPairIndex keeps the bit row of every word, version 1 files are
+# converted when loaded
+MODEL_FORMAT_VERSION = 2
+_ALIGN = 64
+
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+def writeModel(path, kind, arrays, meta):
+    # arrays maps names to numpy arrays, meta must be JSON serializable.
+    # Written to a temporary file and renamed like FeatureStorage.save.
+    arrays = dict((name, np.ascontiguousarray(array)) for name, array in arrays.iteritems())
+    entries = {}
+    offset = 0
+    for name in sorted(arrays):
+        array = arrays[name]
+        entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({'version': MODEL_FORMAT_VERSION, 'kind': kind, 'meta': meta, 'arrays': entries})
+    dataStart = _aligned(len(MODEL_MAGIC) + 4 + len(header))
+
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    fh = open(tmpPath, 'wb')
+    try:
+        fh.write(MODEL_MAGIC)
+        fh.write(struct.pack('<I', len(header)))
+        fh.write(header)
+        for name in sorted(arrays):
+            fh.seek(dataStart + entries[name]['offset'])
+            fh.write(arrays[name].tostring())
+    finally:
+        fh.close()
+    os.rename(tmpPath, path)
+
+
+class ModelFile:
+    # Read side of writeModel. Only the header is read when opening, arrays
+    # are memory-mapped read-only when asked for.
+    def __init__(self, path):
+        self.path = path
+        fh = open(path, 'rb')
+        try:
+            if fh.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+                raise ValueError('%s is not a model file' % path)
+            headerLength = struct.unpack('<I', fh.read(4))[0]
+            header = json.loads(fh.read(headerLength))
+        finally:
+            fh.close()
+        if header['version'] > MODEL_FORMAT_VERSION:
+            raise ValueError('%s has model format version %d, this code reads up to %d' % (path, header['version'], MODEL_FORMAT_VERSION))
+        self.version = header['version']
+        self.kind = header['kind']
+        self.meta = header['meta']
+        self.entries = header['arrays']
+        self.dataStart = _aligned(len(MODEL_MAGIC) + 4 + headerLength)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def array(self, name):
+        entry = self.entries[name]
+        dtype = np.dtype(str(entry['dtype']))
+        shape = tuple(entry['shape'])
+        if int(np.prod(shape)) == 0:
+            # mmap cannot map zero bytes
+            return np.zeros(shape, dtype)
+        return np.memmap(self.path, dtype, 'r', self.dataStart + entry['offset'], shape)
+
+    def arrays(self, prefix):
+        # every array named prefix.<name>, keyed by <name>
+        prefix = prefix + '.'
+        return dict((name[len(prefix):], self.array(name)) for name in self.entries if name.startswith(prefix))
+
+
+def prefixed(prefix, arrays):
+    return dict((prefix + '.' + name, array) for name, array in arrays.iteritems())
+
+
+# LSHash tables are stored as CSR arrays: the sorted hash keys, the offsets
+# of their buckets, and the stored float32 points and extra data in bucket
+# order. Extra data is the triangle id str(x) of TrainingHandler or the
+# (classId, str(x)) pair of MultiLogoModel, kept as one or two int columns.
+# With several tables the ids of the points are stored too. Loaded tables
+# are array storage over the mapped arrays.
+
+def _encodeExtra(extra):
+    if extra is None:
+        return []
+    if isinstance(extra, tuple):
+        return [int(extra[0]), int(extra[1])]
+    return [int(extra)]
+
+def _decodeExtra(row):
+    if len(row) == 0:
+        return None
+    if len(row) == 2:
+        return (int(row[0]), str(int(row[1])))
+    return str(int(row[0]))
+
+class _ExtraColumn:
+    # The extra data of the rows of a loaded table, decoded when indexed
+    def __init__(self, array):
+        self.array = array
+        self.nbytes = array.nbytes
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, row):
+        return _decodeExtra(self.array[row])
+
+    def __iter__(self):
+        for row in xrange(len(self.array)):
+            yield _decodeExtra(self.array[row])
+
+def _encodeExtras(extras):
+    encoded = [_encodeExtra(extra) for extra in extras]
+    width = max([len(extra) for extra in encoded] or [0])
+    if any(len(extra) != width for extra in encoded):
+        raise ValueError('extra data of the stored points differs in kind')
+    return np.asarray(encoded, np.int64).reshape(-1, width)
+
+def lshArrays(lsh):
+    # arrays and metadata of an in-memory LSHash
+    if lsh.hash_size > 63:
+        raise ValueError('hashes longer than 63 bits cannot be stored')
+    arrays = {'planes': np.asarray(lsh.uniform_planes, float)}
+    for i, table in enumerate(lsh.hash_tables):
+        if table.name == 'array':
+            table.keys()
+            arrays['%d.keys' % i] = table.bucket_keys.astype(np.int64)
+            arrays['%d.offsets' % i] = table.offsets
+            if table.points is None:
+                arrays['%d.points' % i] = np.zeros((0, lsh.input_dim), np.float32)
+            else:
+                arrays['%d.points' % i] = np.asarray(table.points, np.float32)
+            if isinstance(table.extras, _ExtraColumn):
+                arrays['%d.extra' % i] = table.extras.array
+            else:
+                arrays['%d.extra' % i] = _encodeExtras(table.extras)
+            if lsh.num_hashtables > 1:
+                arrays['%d.ids' % i] = table.ids
+            continue
+        if table.name != 'dict':
+            raise ValueError('only in-memory hash tables can be stored')
+        keys = sorted(table.storage.keys())
+        values = [value for key in keys for value in table.storage[key]]
+        counts = [len(table.storage[key]) for key in keys]
+        points = [value[0] if isinstance(value[0], tuple) else value for value in values]
+        extras = [value[1] if isinstance(value[0], tuple) else None for value in values]
+        arrays['%d.keys' % i] = np.asarray(keys, np.int64)
+        arrays['%d.offsets' % i] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        arrays['%d.points' % i] = np.asarray(points, np.float32).reshape(-1, lsh.input_dim)
+        arrays['%d.extra' % i] = _encodeExtras(extras)
+    meta = {'hash_size': lsh.hash_size, 'input_dim': lsh.input_dim, 'num_hashtables': lsh.num_hashtables}
+    return arrays, meta
+
+def _tableIds(arrays, count):
+    # Ids of the points of every table. Files written from dict tables have
+    # none, equal points and extra data get the same id.
+    if count == 1 or '0.ids' in arrays:
+        return [arrays['%d.ids' % i] if '%d.ids' % i in arrays else None for i in range(count)]
+    rows = [np.hstack([arrays['%d.points' % i], arrays['%d.extra' % i]]).astype(float) for i in range(count)]
+    ids = np.unique(np.concatenate(rows), axis=0, return_inverse=True)[1]
+    splits = np.cumsum([len(row) for row in rows])[:-1]
+    return np.split(ids.astype(np.int64), splits)
+
+def lshFromArrays(arrays, meta):
+    # float32 points are used as mapped, older files are converted
+    lsh = LSHash(meta['hash_size'], meta['input_dim'], meta['num_hashtables'], storage_config={'array': None})
+    lsh.uniform_planes = [np.array(planes) for planes in arrays['planes']]
+    ids = _tableIds(arrays, lsh.num_hashtables)
+    for i in range(lsh.num_hashtables):
+        lsh.hash_tables[i] = ArrayStorage.from_arrays(arrays['%d.keys' % i], arrays['%d.offsets' % i],
+                                                      arrays['%d.points' % i].astype(np.float32, copy=False),
+                                                      _ExtraColumn(arrays['%d.extra' % i]), ids[i])
+    return lsh
@@ -0,0 +1,120 @@
+import os
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+
+import edge_index
+import vocabulary
+from lshash import LSHash
+from training_handler import TrainingHandler
+from feature_storage import FeatureStorage
+
+# Rough size of one stored LSH point besides its coordinates: the tuple, the
+# floats and the extra data
+_LSH_ENTRY_OVERHEAD = 200
+
+
+def estimateBytes(value):
+    # Approximate memory held by a model attribute
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, edge_index.ClassEdgeIndex):
+        return value.keys.nbytes + value.classMasks.nbytes
+    if isinstance(value, edge_index.PackedKeySet):
+        return value.keys.nbytes
+    if isinstance(value, edge_index.WordPairIndex):
+        return value.bits.nbytes
+    if isinstance(value, vocabulary.VocabularyTree):
+        return sum(array.nbytes for array in value.toArrays().values())
+    if isinstance(value, LSHash):
+        points = sum(len(bucket) for table in value.hash_tables if table.name == 'dict' for bucket in table.storage.itervalues())
+        arrays = sum(table.nbytes() for table in value.hash_tables if table.name == 'array')
+        return points * (value.input_dim * 8 + _LSH_ENTRY_OVERHEAD) + arrays
+    if isinstance(value, (list, tuple)):
+        if len(value) == 0:
+            return 0
+        # lists of rows, the first row stands for all of them
+        return len(value) * (estimateBytes(value[0]) + 64)
+    return 64
+
+def estimateModelBytes(model):
+    # Only what is loaded counts, attributes a lazily opened TrainingHandler
+    # has not read yet are not in its __dict__
+    return sum(estimateBytes(value) for value in model.__dict__.itervalues())
+
+
+class ModelRegistry:
+    # Loaded models by name, shared by every caller of the process. A model is
+    # loaded again when its file was replaced (a retrain or a migration to a
+    # new format version writes a new file), and the least recently used
+    # models are dropped once the loaded ones exceed memoryBudgetMB.
+    def __init__(self, memoryBudgetMB=2048, checkInterval=1.0):
+        self.memoryBudget = int(memoryBudgetMB) << 20
+        # seconds between two checks of the same model file
+        self.checkInterval = checkInterval
+        # (name, loader) -> [fileStamp, lastCheck, model]
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def fileStamp(self, name):
+        # Identity of the file a model is loaded from, None without a file
+        FS = FeatureStorage(name)
+        for path in (FS.modelPath(), FS.picklePath()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            return (path, st.st_mtime, st.st_size, st.st_ino)
+        return None
+
+    def get(self, name, loader=TrainingHandler):
+        # The model of logo class (or MultiLogoModel) name, loader(name)
+        # loads it
+        key = (name, loader)
+        now = time.time()
+        with self.lock:
+            entry = self.models.pop(key, None)
+            if entry is not None:
+                if now - entry[1] >= self.checkInterval:
+                    stamp = self.fileStamp(name)
+                    if stamp != entry[0]:
+                        entry = None
+                    else:
+                        entry[1] = now
+            if entry is None:
+                stamp = self.fileStamp(name)
+                entry = [stamp, now, loader(name)]
+                self.models[key] = entry
+                self.evict()
+            else:
+                self.models[key] = entry
+            return entry[2]
+
+    def evict(self):
+        # Drops least recently used models until the budget holds, the most
+        # recently used model always stays
+        sizes = [estimateModelBytes(entry[2]) for entry in self.models.itervalues()]
+        total = sum(sizes)
+        while total > self.memoryBudget and len(self.models) > 1:
+            self.models.popitem(last=False)
+            total -= sizes.pop(0)
+
+    def remove(self, name, loader=TrainingHandler):
+        with self.lock:
+            self.models.pop((name, loader), None)
+
+    def loadedBytes(self):
+        with self.lock:
+            return sum(estimateModelBytes(entry[2]) for entry in self.models.itervalues())
+
+_sharedRegistry = None
+_sharedRegistryLock = threading.Lock()
+
+def sharedRegistry():
+    # Process-wide registry used by main and long running recognizers
+    global _sharedRegistry
+    with _sharedRegistryLock:
+        if _sharedRegistry is None:
+            _sharedRegistry = ModelRegistry()
+    return _sharedRegistry
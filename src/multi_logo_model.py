@@ -0,0 +1,103 @@
+import numpy as np
+from lshash import LSHash
+import time
+
+import edge_index
+import vocabulary
+import triangle_generator
+import model_format
+from feature_storage import FeatureStorage
+from os.path import isfile
+
+class MultiLogoModel():
+    # One model for many logo classes: a shared visual vocabulary, and edge and
+    # triangle indexes whose entries are tagged with the class id, so a query
+    # image is matched against every class in one pass (Recognizer.recognizeAll).
+    def __init__(self, model_name='all'):
+
+        self.model_name = model_name
+
+        FS = FeatureStorage(model_name)
+        if isfile(FS.modelPath()):
+            # every part is used for recognition, the arrays stay memory-mapped
+            modelFile = FS.openArrays()
+            self.logoNames = [str(name) for name in modelFile.meta['logoNames']]
+            self.centroids = modelFile.array('centroids')
+            self.dVisualWordIndexCheck = edge_index.WordPairIndex.fromArrays(modelFile.arrays('dVisualWordIndexCheck'))
+            self.edgeIndex = edge_index.ClassEdgeIndex.fromArrays(modelFile.arrays('edgeIndex'))
+            self.trianglesIndexLSH = model_format.lshFromArrays(modelFile.arrays('trianglesIndexLSH'),modelFile.meta['trianglesIndexLSH'])
+            self.wordAssigner = vocabulary.VocabularyTree.fromArrays(modelFile.arrays('wordAssigner'),
+                modelFile.meta['wordAssignerProbes'],modelFile.meta['wordAssignerAgreement'])
+
+        elif isfile(FS.picklePath()):
+            # Pickled model of an earlier version, save_model migrates it
+            data = FS.load()
+
+            (self.logoNames,\
+            self.centroids,\
+            self.dVisualWordIndexCheck,\
+            self.edgeIndex,\
+            self.trianglesIndexLSH) = data[:5]
+
+            # Models saved before the vocabulary tree get one built on load
+            if len(data) > 5:
+                self.wordAssigner = data[5]
+            else:
+                self.wordAssigner = vocabulary.VocabularyTree(self.centroids)
+
+        else:
+            self.logoNames = []
+            self.centroids = None
+            self.dVisualWordIndexCheck = edge_index.WordPairIndex()
+            self.edgeIndex = edge_index.ClassEdgeIndex()
+            self.trianglesIndexLSH = LSHash(32, 8, storage_config={'array': None})
+            self.wordAssigner = None
+
+    def build(self, trHandlers, words=2000, vocabularyBuilder=None):
+        # trHandlers are trained TrainingHandlers, one per logo class. Their
+        # descriptors are clustered into a shared vocabulary and their
+        # triangles are indexed again with the shared visual words.
+        if vocabularyBuilder is None:
+            vocabularyBuilder = vocabulary.MiniBatchVocabulary(words)
+        if len(trHandlers) > edge_index.ClassEdgeIndex.MAX_CLASSES:
+            raise ValueError('at most %d classes per model' % edge_index.ClassEdgeIndex.MAX_CLASSES)
+
+        tStart = time.time()
+        self.logoNames = [trHandler.logo_name for trHandler in trHandlers]
+        desArrays = [np.asarray(trHandler.trainedDescriptorsList,float).reshape(-1,128) for trHandler in trHandlers]
+        self.centroids = vocabularyBuilder.build(np.vstack(desArrays))[0]
+        self.wordAssigner = vocabulary.VocabularyTree(self.centroids)
+        self.dVisualWordIndexCheck = edge_index.WordPairIndex(max(words,len(self.centroids)))
+        self.edgeIndex = edge_index.ClassEdgeIndex()
+        self.trianglesIndexLSH = LSHash(32, 8, storage_config={'array': None})
+
+        for classId,(trHandler,desArray) in enumerate(zip(trHandlers,desArrays)):
+            if len(desArray) == 0:
+                continue
+            labels = self.wordAssigner.assign(desArray)
+            wordPairs,edges,trianglePoints = triangle_generator.triangleIndexEntries(trHandler.triangleVWwith6anglesFeatureList,labels)
+            self.dVisualWordIndexCheck[wordPairs[:,0],wordPairs[:,1]] = True
+            self.edgeIndex.add(edges[:,0],edges[:,1],edges[:,2],edges[:,3],classId)
+            triangleExtraData = [(classId,str(x)) for x in range(len(trianglePoints)//6) for _ in range(6)]
+            self.trianglesIndexLSH.index_batch(trianglePoints,extra_data=triangleExtraData)
+
+        self.save_model()
+        tEnd = time.time()
+        print "cost %f sec" % (tEnd - tStart)
+
+    def save_model(self):
+        # Writes the model in the array format of model_format.py
+        lshArrays,lshMeta = model_format.lshArrays(self.trianglesIndexLSH)
+        arrays = {'centroids': np.asarray(self.centroids)}
+        arrays.update(model_format.prefixed('trianglesIndexLSH',lshArrays))
+        arrays.update(model_format.prefixed('dVisualWordIndexCheck',self.dVisualWordIndexCheck.toArrays()))
+        arrays.update(model_format.prefixed('edgeIndex',self.edgeIndex.toArrays()))
+        arrays.update(model_format.prefixed('wordAssigner',self.wordAssigner.toArrays()))
+        meta = {
+            'logoNames': self.logoNames,
+            'trianglesIndexLSH': lshMeta,
+            'wordAssignerProbes': self.wordAssigner.probes,
+            'wordAssignerAgreement': self.wordAssigner.agreementRate}
+
+        FS = FeatureStorage(self.model_name)
+        FS.saveArrays('MultiLogoModel',arrays,meta)
@@ -0,0 +1,149 @@
+import time
+import itertools
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Edges shorter or longer than this (in pixels) are never used for matching
+EDGE_MIN_LENGTH = 3.0
+EDGE_MAX_LENGTH = 50.0
+
+
+def keypointCoordinates(kp):
+    # (n,2) float array of keypoint positions in opencv coordinates
+    if len(kp) == 0:
+        return np.zeros((0,2),float)
+    return np.array([k.pt for k in kp],float)
+
+def keypointAngles(kp):
+    return np.array([k.angle for k in kp],float)
+
+def radiusNeighbourPairs(points, minDist=EDGE_MIN_LENGTH, maxDist=EDGE_MAX_LENGTH, stats=None):
+    # Return index arrays (I,J), I < J, of every point pair whose distance lies
+    # in [minDist, maxDist]. A KD-tree only visits local neighbours, so the cost
+    # follows the neighbourhood size instead of n*n. A stats dict gets the
+    # number of pairs within maxDist ('pairsExamined') and of those shorter
+    # than minDist ('pairsRejectedLength') added.
+    points = np.asarray(points,float)
+    if len(points) < 2:
+        return np.zeros(0,np.intp),np.zeros(0,np.intp)
+
+    tree = cKDTree(points)
+    pairs = tree.query_pairs(maxDist, output_type='ndarray')
+    if len(pairs) == 0:
+        return np.zeros(0,np.intp),np.zeros(0,np.intp)
+
+    # query_pairs gives no particular order, sort so the output is stable
+    pairs = pairs[np.lexsort((pairs[:,1],pairs[:,0]))]
+    I = pairs[:,0].astype(np.intp)
+    J = pairs[:,1].astype(np.intp)
+    v = points[J] - points[I]
+    length = np.sqrt(v[:,0]*v[:,0]+v[:,1]*v[:,1])
+    keep = length >= minDist
+    if stats is not None:
+        stats['pairsExamined'] = stats.get('pairsExamined',0) + len(keep)
+        stats['pairsRejectedLength'] = stats.get('pairsRejectedLength',0) + len(keep) - int(keep.sum())
+    return I[keep],J[keep]
+
+class NeighbourPairSampler(object):
+    # The pairs of radiusNeighbourPairs, sampled within a work budget without
+    # building the full pair list. Points are visited as anchors in a seeded
+    # order that takes turns between the maxDist wide grid cells of the image,
+    # and each anchor adds its pairs to the points not visited before it.
+    # Sampling stops at maxPairs pairs or after maxSeconds, so any budget
+    # gives whole neighbourhoods spread over the image, and the same points,
+    # seed and pair budget always give the same pairs. complete is False
+    # once the budget left out a pair, visited is the number of
+    # anchors visited so far. A pair not sampled yet joins two points not
+    # visited yet. stats gets the counts of radiusNeighbourPairs.
+    def __init__(self, points, maxPairs=None, maxSeconds=None, seed=0, minDist=EDGE_MIN_LENGTH, maxDist=EDGE_MAX_LENGTH, chunk=64, stats=None):
+        self.tStart = time.time()
+        self.points = np.asarray(points,float)
+        self.maxPairs = maxPairs
+        self.maxSeconds = maxSeconds
+        self.seed = seed
+        self.minDist = minDist
+        self.maxDist = maxDist
+        self.chunk = chunk
+        self.stats = stats
+        self.count = 0
+        self.visited = 0
+        self.complete = True
+
+    def anchorOrder(self):
+        # the k-th anchor of every cell comes before the (k+1)-th of any cell,
+        # cells take turns in a seeded order
+        n = len(self.points)
+        random = np.random.RandomState(self.seed)
+        cells = np.floor(self.points/self.maxDist).astype(np.int64)
+        cells -= cells.min(axis=0)
+        cellIds,cellOf = np.unique(cells[:,0]*(cells[:,1].max()+1) + cells[:,1],return_inverse=True)
+        order = random.permutation(n)
+        byCell = np.argsort(cellOf[order],kind='mergesort')
+        sortedCells = cellOf[order][byCell]
+        rank = np.empty(n,np.intp)
+        rank[byCell] = np.arange(n) - np.searchsorted(sortedCells,sortedCells)
+        cellTurn = random.permutation(len(cellIds))
+        return order[np.lexsort((cellTurn[cellOf[order]],rank))]
+
+    def chunks(self):
+        # Yields the sampled pairs as (I,J) arrays, I < J, in visiting order.
+        # Stopping early leaves a valid smaller sample.
+        points = self.points
+        n = len(points)
+        if n < 2:
+            return
+        anchors = self.anchorOrder()
+        visitedAt = np.empty(n,np.intp)
+        visitedAt[anchors] = np.arange(n)
+        tree = cKDTree(points)
+        for start in xrange(0,n,self.chunk):
+            if start > 0 and self.maxSeconds is not None and time.time() - self.tStart >= self.maxSeconds:
+                self.complete = not self.pairsLeft(tree,anchors,visitedAt,start)
+                return
+            a = anchors[start:start+self.chunk]
+            self.visited = start + len(a)
+            I,J,examined = self.anchorPairs(tree,a,visitedAt)
+            if self.stats is not None:
+                self.stats['pairsExamined'] = self.stats.get('pairsExamined',0) + examined
+                self.stats['pairsRejectedLength'] = self.stats.get('pairsRejectedLength',0) + examined - len(I)
+            if self.maxPairs is not None and self.count + len(I) >= self.maxPairs:
+                take = self.maxPairs - self.count
+                self.complete = take == len(I)
+                self.count += take
+                yield np.minimum(I[:take],J[:take]),np.maximum(I[:take],J[:take])
+                if self.complete:
+                    self.complete = not self.pairsLeft(tree,anchors,visitedAt,start+self.chunk)
+                return
+            self.count += len(I)
+            yield np.minimum(I,J),np.maximum(I,J)
+
+    def anchorPairs(self, tree, a, visitedAt):
+        # (I,J) pairs of the anchors a to points visited after them, and the
+        # number of those pairs within maxDist
+        points = self.points
+        neighbours = tree.query_ball_point(points[a],self.maxDist)
+        J = np.fromiter(itertools.chain.from_iterable(neighbours),np.intp)
+        I = np.repeat(a,[len(x) for x in neighbours])
+        later = visitedAt[J] > visitedAt[I]
+        I = I[later]
+        J = J[later]
+        v = points[J] - points[I]
+        keep = np.sqrt(v[:,0]*v[:,0]+v[:,1]*v[:,1]) >= self.minDist
+        return I[keep],J[keep],len(keep)
+
+    def pairsLeft(self, tree, anchors, visitedAt, start):
+        # Whether the anchors from start on have any pair, asked once the
+        # budget is spent. Stops at the first chunk with a pair, which is
+        # usually the next one.
+        for s in xrange(start,len(anchors),self.chunk):
+            if len(self.anchorPairs(tree,anchors[s:s+self.chunk],visitedAt)[0]):
+                return True
+        return False
+
+def sampleNeighbourPairs(points, maxPairs=None, maxSeconds=None, seed=0, minDist=EDGE_MIN_LENGTH, maxDist=EDGE_MAX_LENGTH, chunk=64, stats=None):
+    # All pairs of a NeighbourPairSampler as (I,J,complete)
+    sampler = NeighbourPairSampler(points,maxPairs,maxSeconds,seed,minDist,maxDist,chunk,stats)
+    pairs = list(sampler.chunks())
+    if not pairs:
+        return np.zeros(0,np.intp),np.zeros(0,np.intp),sampler.complete
+    return np.concatenate([I for I,J in pairs]),np.concatenate([J for I,J in pairs]),sampler.complete
@@ -0,0 +1,76 @@
+import sys
+import threading
+import Queue
+
+# Marks the end of the items in a stage queue
+_DONE = object()
+
+
+class StageError(object):
+    # Takes the place of an item whose stage raised, later stages pass it on
+    def __init__(self, stage, exc_info):
+        self.stage = stage
+        self.exc_info = exc_info
+
+    def __repr__(self):
+        return 'StageError(%r, %r)' % (self.stage, self.exc_info[1])
+
+
+def runPipeline(items, stages, queueSize=8):
+    # Runs every item through stages, a list of (name, function, workers).
+    # Each stage has its own threads reading from a bounded queue, so the
+    # stages work on different items at the same time and at most queueSize
+    # items wait between two stages. Functions that release the GIL (file IO,
+    # cv2, numpy) run in parallel. Returns the outputs in item order, an item
+    # whose stage raised gives a StageError.
+    queues = [Queue.Queue(queueSize) for _ in range(len(stages)+1)]
+    results = [None]*len(items)
+    threads = []
+
+    def feed():
+        for index,item in enumerate(items):
+            queues[0].put((index,item))
+        for _ in range(stages[0][2]):
+            queues[0].put(_DONE)
+
+    def work(s, remaining, lock):
+        name,function,workers = stages[s]
+        nextWorkers = stages[s+1][2] if s+1 < len(stages) else 1
+        while True:
+            entry = queues[s].get()
+            if entry is _DONE:
+                break
+            index,item = entry
+            if not isinstance(item,StageError):
+                try:
+                    item = function(item)
+                except Exception:
+                    item = StageError(name,sys.exc_info())
+            queues[s+1].put((index,item))
+        # the last worker of a stage ends the next one
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(nextWorkers):
+                queues[s+1].put(_DONE)
+
+    threads.append(threading.Thread(target=feed))
+    for s,(name,function,workers) in enumerate(stages):
+        remaining = [workers]
+        lock = threading.Lock()
+        for _ in range(workers):
+            threads.append(threading.Thread(target=work,args=(s,remaining,lock)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    while True:
+        entry = queues[-1].get()
+        if entry is _DONE:
+            break
+        index,item = entry
+        results[index] = item
+    for thread in threads:
+        thread.join()
+    return results
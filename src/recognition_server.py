@@ -0,0 +1,269 @@
+import json
+import sys
+import time
+import threading
+import Queue
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from collections import deque
+
+import model_registry
+from recognizer import Recognizer
+from training_handler import TrainingHandler
+from multi_logo_model import MultiLogoModel
+
+# USAGE:
+#   python recognition_server.py 8765
+#   curl --data-binary @logo.jpg 'http://127.0.0.1:8765/recognize?model=adidas'
+#   curl -d '{"model": "all", "kind": "all", "paths": ["a.jpg", "b.jpg"]}' http://127.0.0.1:8765/recognize
+#   curl http://127.0.0.1:8765/metrics
+
+# Model kinds a request can ask for
+MODEL_LOADERS = {'class': TrainingHandler, 'all': MultiLogoModel}
+
+
+class ServerMetrics:
+    # Request latency and throughput of a running server
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batchedImages = 0
+        # latencies of the last window images, and when they finished
+        self.latencies = deque(maxlen=window)
+        self.finished = deque(maxlen=window)
+
+    def recordBatch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batchedImages += size
+
+    def recordImage(self, latency, failed):
+        with self.lock:
+            self.requests += 1
+            if failed:
+                self.errors += 1
+            self.latencies.append(latency)
+            self.finished.append(time.time())
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            latencies = sorted(self.latencies)
+            recent = [t for t in self.finished if now - t <= 60.0]
+            def percentile(p):
+                if not latencies:
+                    return None
+                return latencies[min(len(latencies)-1, int(p*len(latencies)))]
+            return {
+                'uptime': now - self.started,
+                'images': self.requests,
+                'errors': self.errors,
+                'batches': self.batches,
+                'meanBatchSize': float(self.batchedImages)/self.batches if self.batches else 0.0,
+                'latency': {'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99),
+                            'mean': sum(latencies)/len(latencies) if latencies else None},
+                'throughput': {'total': self.requests/max(now - self.started, 1e-9),
+                               'lastMinute': len(recent)/60.0}}
+
+
+class _Request:
+    def __init__(self, modelKey, image):
+        self.modelKey = modelKey
+        self.image = image
+        self.tStart = time.time()
+        self.done = threading.Event()
+        self.result = None
+
+
+class MicroBatcher:
+    # Collects concurrent requests for up to maxWait seconds or maxBatch
+    # images and recognizes them together with recognize_batch, so decoding,
+    # SIFT and matching of the requests overlap and their triangles share one
+    # LSH query. Every (model, kind) has its own queue and worker thread, so
+    # requests for different models are recognized at the same time.
+    def __init__(self, recognizer, registry, metrics, maxBatch=16, maxWait=0.01):
+        self.recognizer = recognizer
+        self.registry = registry
+        self.metrics = metrics
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+        self.lock = threading.Lock()
+        # (name, kind) -> queue of its worker
+        self.queues = {}
+
+    def submit(self, modelKey, image):
+        # Blocks until the image is recognized, returns its result dict
+        request = _Request(modelKey, image)
+        self.queueOf(modelKey).put(request)
+        request.done.wait()
+        return request.result
+
+    def queueOf(self, modelKey):
+        # The queue of a model, its worker starts with the first request
+        with self.lock:
+            queue = self.queues.get(modelKey)
+            if queue is None:
+                queue = self.queues[modelKey] = Queue.Queue()
+                thread = threading.Thread(target=self.run, args=(modelKey, queue))
+                thread.daemon = True
+                thread.start()
+            return queue
+
+    def run(self, modelKey, queue):
+        name, kind = modelKey
+        while True:
+            batch = [queue.get()]
+            deadline = time.time() + self.maxWait
+            while len(batch) < self.maxBatch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(queue.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+            self.metrics.recordBatch(len(batch))
+
+            try:
+                results = self.recognize(name, kind, [request.image for request in batch])
+            except Exception as e:
+                results = [{'path': None, 'error': '%r' % (e,)} for request in batch]
+            for request, result in zip(batch, results):
+                request.result = result
+                self.metrics.recordImage(time.time() - request.tStart, result.get('error') is not None)
+                request.done.set()
+
+    def check(self, name, kind):
+        # None for a model that can be recognized, otherwise the (HTTP
+        # status, error) of the request
+        if kind not in MODEL_LOADERS:
+            return 400, 'unknown model kind %s' % kind
+        if self.registry.fileStamp(name) is None:
+            return 404, 'no model named %s' % name
+        return None
+
+    def recognize(self, name, kind, images):
+        error = self.check(name, kind)
+        if error is not None:
+            raise ValueError(error[1])
+        model = self.registry.get(name, MODEL_LOADERS[kind])
+        return self.recognizer.recognize_batch(images, model)
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # POST /recognize?model=<name>[&kind=class|all] with the image bytes as
+    # body, or with a JSON body {"model", "kind", "paths"} for image files
+    # the server can read. GET /metrics and GET /health. An unknown kind is
+    # answered with 400, a model that does not exist with 404.
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        if path == '/metrics':
+            self.reply(200, self.server.metrics.snapshot())
+        elif path == '/health':
+            self.reply(200, {'status': 'ok'})
+        else:
+            self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/recognize':
+            self.reply(404, {'error': 'not found'})
+            return
+        query = urlparse.parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+
+        if self.headers.getheader('content-type', '').startswith('application/json'):
+            try:
+                request = json.loads(body)
+                images = [str(path) for path in request['paths']]
+                name = str(request['model'])
+                kind = str(request.get('kind', 'class'))
+            except (ValueError, KeyError, TypeError) as e:
+                self.reply(400, {'error': 'bad request: %r' % (e,)})
+                return
+        else:
+            if 'model' not in query:
+                self.reply(400, {'error': 'model is missing'})
+                return
+            name = query['model'][0]
+            kind = query.get('kind', ['class'])[0]
+            images = [(query.get('name', ['upload'])[0], body)]
+        error = self.server.batcher.check(name, kind)
+        if error is not None:
+            self.reply(error[0], {'error': error[1]})
+            return
+
+        # each image is its own request to the batcher, so the images of
+        # this call are batched together with those of concurrent calls
+        results = [None]*len(images)
+        def submit(i):
+            results[i] = self.server.batcher.submit((name, kind), images[i])
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(1, len(images))]
+        for thread in threads:
+            thread.start()
+        if images:
+            submit(0)
+        for thread in threads:
+            thread.join()
+        self.reply(200, {'results': results})
+
+    def reply(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # request lines would flood the log, /metrics has the numbers
+        pass
+
+
+class RecognitionServer:
+    # Long running HTTP recognition service on localhost. Models stay loaded
+    # in the model registry between requests.
+    def __init__(self, host='127.0.0.1', port=8765, maxBatch=16, maxWait=0.01, registry=None):
+        self.metrics = ServerMetrics()
+        self.registry = registry or model_registry.sharedRegistry()
+        self.batcher = MicroBatcher(Recognizer(), self.registry, self.metrics, maxBatch, maxWait)
+        self.httpd = _ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.metrics = self.metrics
+        self.httpd.batcher = self.batcher
+        self.thread = None
+
+    def address(self):
+        # (host, port), port 0 binds a free port
+        return self.httpd.server_address
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def start(self):
+        # serves from a background thread
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    server = RecognitionServer(port=port)
+    print 'serving on http://%s:%d' % server.address()
+    server.serve_forever()
@@ -1,57 +1,70 @@
 import cv2
-import itertools
 from training_handler import TrainingHandler
 import math_formula
-from math import sqrt,degrees,acos
+import pair_generator
+import triangle_generator
+import edge_index
+import feature_cache
+import pipeline
+from instrumentation import sharedInstrumentation, NULL_RECORD
+from multi_logo_model import MultiLogoModel
 import numpy as np
 # from lshash import LSHash
-from scipy.cluster.vq import vq
 import time
-import random
+
+def classOfValue(value):
+    # Class of a trained triangle in the multi logo LSH index, one function
+    # object so array tables keep the class of every row between queries
+    return value[1][0]
+
+class _PreparedImage:
+    # An image matched up to the LSH query by Recognizer.prepareMatch.
+    # queryImgTriangles is None for an image without features to query.
+    def __init__(self, result, record):
+        self.result = result
+        self.record = record
+        self.stats = None
+        self.queryImgTriangles = None
+        # triangle keys of every class and their union, of a multi logo image
+        self.classKeys = None
+        self.tripeKeys = None
 
 class Recognizer():
-    def __init__(self):
+    def __init__(self, instrumentation=None, maxPairs=100000, maxPairSeconds=None, seed=0, cascadeRound=500, cascadeChunk=64, cascadeEstimate=None, lshProbes=1):
         self.img_traingle_counter = {}
+        # Work budget of edge sampling per image, see sampleEdges
+        self.maxPairs = maxPairs
+        self.maxPairSeconds = maxPairSeconds
+        self.seed = seed
+        # Sampled pairs of the first round and triangles of the first query
+        # of matchCascade
+        self.cascadeRound = cascadeRound
+        self.cascadeChunk = cascadeChunk
+        # None: the cascade only takes exact decisions. A factor k > 1 lets
+        # it also reject on an estimate of the final count, see matchCascade
+        self.cascadeEstimate = cascadeEstimate
+        # LSH buckets probed per triangle, more find more trained triangles
+        # at a higher cost. Thresholds hold for the probes they were
+        # validated with.
+        self.lshProbes = lshProbes
+        # counters and stage timings of every image, see instrumentation.py
+        self.instrumentation = instrumentation or sharedInstrumentation()
 
-    def createAtriangle(self,tripePoint,kp,keyIds,imgpath):
-
-        keyindexi,keyindexj,keyindexk = list(tripePoint)
-        # print tripePoint
-        # print keyindexi,keyindexj,keyindexk
-        ix = kp[keyindexi].pt[0]
-        iy = -kp[keyindexi].pt[1]
-        jx = kp[keyindexj].pt[0]
-        jy = -kp[keyindexj].pt[1]
-        kx = kp[keyindexk].pt[0]
-        ky = -kp[keyindexk].pt[1]
-        vikx = float(kx - ix)
-        viky = float(ky - iy)
-        vijx = float(jx - ix)
-        vijy = float(jy - iy)
-        length_vik = sqrt(abs(vikx*vikx+viky*viky))
-        length_vij = sqrt(abs(vijx*vijx+vijy*vijy))
-        if length_vij == 0.0:
-            length_vij = 1.0
-        if length_vik == 0.0:
-            length_vik = 1.0
-        vcos = (vikx*vijx+viky*vijy)/length_vik/length_vij
-        delta1 = degrees(acos(round(vcos,13)))
-        vjkx = float(kx - jx)
-        vjky = float(ky - jy)
-        vjix = -vijx
-        vjiy = -vijy
-        length_vjk = sqrt(abs(vjkx*vjkx+vjky*vjky))
-        length_vji = sqrt(abs(vjix*vjix+vjiy*vjiy))
-        if length_vjk == 0.0:
-            length_vjk = 1.0
-        if length_vji == 0.0:
-            length_vji = 1.0
-        vcos = (vjkx*vjix+vjky*vjiy)/length_vjk/length_vji
-        delta2 = degrees(acos(round(vcos,13)))
-        t_alpha = math_formula.computeRelativeAngle(kp[keyindexi].angle,vijx,vijy)
-        t_beta = math_formula.computeRelativeAngle(kp[keyindexj].angle,vjkx,vjky)
-        t_gamma = math_formula.computeRelativeAngle(kp[keyindexk].angle,-vikx,-viky)
-        return [keyIds[keyindexi],keyIds[keyindexj],keyIds[keyindexk],delta1,delta2,t_alpha,t_beta,t_gamma,kp[keyindexi],kp[keyindexj],kp[keyindexk],imgpath]
+    def createTriangles(self,triangles,kp,keyIds,imgpath):
+        # Change coordinate to:->x ^y (opencv:->x vy)
+        points = pair_generator.keypointCoordinates(kp)
+        points[:,1] = -points[:,1]
+        angles = pair_generator.keypointAngles(kp)
+        vij,vjk,vik,length_vij,length_vjk,length_vik,delta1,delta2 = triangle_generator.triangleShape(points,triangles)
+        I,J,K = triangles[:,0],triangles[:,1],triangles[:,2]
+        t_alpha = math_formula.computeRelativeAngles(angles[I],vij[:,0],vij[:,1])
+        t_beta = math_formula.computeRelativeAngles(angles[J],vjk[:,0],vjk[:,1])
+        t_gamma = math_formula.computeRelativeAngles(angles[K],-vik[:,0],-vik[:,1])
+
+        queryImgTriangles = []
+        for x,(keyindexi,keyindexj,keyindexk) in enumerate(triangles.tolist()):
+            queryImgTriangles.append([keyIds[keyindexi],keyIds[keyindexj],keyIds[keyindexk],delta1[x],delta2[x],t_alpha[x],t_beta[x],t_gamma[x],kp[keyindexi],kp[keyindexj],kp[keyindexk],imgpath])
+        return queryImgTriangles
 
     def drawTrianglePair(self,triangle1,trTriangle):
         img1 = cv2.imread(triangle1[11])
@@ -83,106 +96,457 @@ class Recognizer():
         cv2.waitKey(0)
         cv2.destroyAllWindows()
 
-    def recognize(self,imgpath,trHandler):
+    def detectFeatures(self,imgpath):
+        # find the keypoints and descriptors with SIFT, repeated images come from the cache
+        return feature_cache.sharedCache().detectAndCompute(imgpath)
+
+    def sampleEdges(self,kp,stats=None):
+        # Only pairs inside the [3,50] px annulus are generated, at most
+        # maxPairs of them and for at most maxPairSeconds. The sample is
+        # seeded and spread over the image, the same image always gets the
+        # same pairs under a pair budget.
+        kpPoints = pair_generator.keypointCoordinates(kp)
+        kpAngles = pair_generator.keypointAngles(kp)
+        pairI,pairJ,complete = pair_generator.sampleNeighbourPairs(kpPoints,self.maxPairs,self.maxPairSeconds,self.seed,stats=stats)
+        if stats is not None and not complete:
+            stats['pairBudgetHits'] = stats.get('pairBudgetHits',0) + 1
+        alphas,betas = self.edgeAngles(kpPoints,kpAngles,pairI,pairJ)
+        return pairI,pairJ,alphas,betas
 
-        img = cv2.imread(imgpath)
-        # Initiate SIFT detector
-        sift = cv2.SIFT()
+    def edgeAngles(self,kpPoints,kpAngles,pairI,pairJ):
+        # Change coordinate to:->x ^y (opencv:->x vy)
+        vix = kpPoints[pairJ,0] - kpPoints[pairI,0]
+        viy = kpPoints[pairI,1] - kpPoints[pairJ,1]
+        alphas = math_formula.computeRelativeAngles(kpAngles[pairI],vix,viy)
+        betas = math_formula.computeRelativeAngles(kpAngles[pairJ],-vix,-viy)
+        return alphas,betas
 
-        # find the keypoints and descriptors with SIFT
-        kp, des = sift.detectAndCompute(img,None)
+    def matchEdges(self,Ids,pairI,pairJ,alphas,betas,trHandler,record=NULL_RECORD):
+        # Mask of the pairs whose words and angles form a trained edge
+        ki = Ids[pairI]
+        kj = Ids[pairJ]
+        edgeMatch = trHandler.dVisualWordIndexCheck[ki,kj]
+        record.count('wordPairHits',edgeMatch.sum())
+        # temp = trHandler.edgesIndexLSH.query([keyIds[i],keyIds[j],alpha,beta],1)
+        edgeMatch[edgeMatch] = trHandler.edgeIndexHash.containsNear(ki[edgeMatch],kj[edgeMatch],
+            edge_index.angleBins(alphas[edgeMatch]),edge_index.angleBins(betas[edgeMatch]))
+        return edgeMatch
 
-        desArray = np.asarray(des)
-        Ids = list(vq(desArray, trHandler.centroidsOfKmean2000[0])[0])
-        keyIds = [x*1000 for x in Ids]
+    def emptyResult(self,imgpath,keypoints=0):
+        # Result of one image, see matchFeatures. decision is that of the
+        # cascade thresholds, if any.
+        return {'path': imgpath, 'keypoints': keypoints, 'pairs': 0, 'edgeMatches': 0,
+                'triangles': 0, 'matches': 0, 'decision': None, 'seconds': 0.0, 'error': None}
 
-        kppairs_num = list(itertools.combinations(range(len(kp)),2))
-        print len(kppairs_num)
-        matchSimpleEdgePairNum = []
-        matchPointNum = set()
+    def matchFeatures(self,kp,des,trHandler,imgpath=None,record=None,thresholds=None):
+        # Matches the features of one image against a TrainingHandler and
+        # returns the result dict of emptyResult. Nothing of the Recognizer
+        # is changed, so any number of threads can share it and the model.
+        # record is the CallRecord of a caller that times more stages,
+        # otherwise the image gets its own record. With CascadeThresholds of
+        # the class (see cascade.py) matching stops at the decision, see
+        # matchCascade.
+        ownRecord = record is None
+        if ownRecord:
+            record = self.instrumentation.begin('recognize',imgpath)
+        if thresholds is None:
+            result = self.matchPrepared([self.prepareMatch(kp,des,trHandler,imgpath,record)],trHandler)[0]
+        else:
+            result = self.emptyResult(imgpath,len(kp))
+            record.count('keypoints',len(kp))
+            if des is not None and len(kp) >= 3:
+                tStart = time.time()
+                stats = {}
+                Ids = trHandler.wordAssigner.assign(np.asarray(des))
+                record.lap('words')
+                self.matchCascade(kp,Ids,trHandler,thresholds,result,imgpath,record,stats)
+                result['seconds'] = time.time() - tStart
+                record.lap('lsh')
+                self.recordResult(record,result,stats)
+        if ownRecord:
+            self.instrumentation.finish(record)
+        return result
 
-        # Time Start
+    def prepareMatch(self,kp,des,model,imgpath=None,record=NULL_RECORD):
+        # The stages of matchFeatures, or of matchFeaturesAll for a
+        # MultiLogoModel, up to the LSH query: words, pairs, matched edges
+        # and the query triangles. matchPrepared runs the query of any number
+        # of prepared images.
+        multi = isinstance(model, MultiLogoModel)
+        prepared = _PreparedImage(self.emptyResult(imgpath,len(kp)),record)
+        if multi:
+            prepared.result['matches'] = dict((logo_name,0) for logo_name in model.logoNames)
+        record.count('keypoints',len(kp))
+        if des is None or len(kp) < 3:
+            return prepared
         tStart = time.time()
-        maxcount = 0
-        random.shuffle(kppairs_num)
-        while kppairs_num and maxcount < 100000:
-            i,j = kppairs_num.pop()
-        # for i,j in kppairs_num:
-            ix = kp[i].pt[0]
-            iy = -kp[i].pt[1]
-            jx = kp[j].pt[0]
-            jy = -kp[j].pt[1]
-            vix = jx - ix
-            viy = jy - iy
-            length = sqrt(abs(vix*vix+viy*viy))
-            if length < 3.0 or length > 50.0:
-                continue
-            maxcount = maxcount + 1
-            alpha = math_formula.computeRelativeAngle(kp[i].angle,vix,viy)
-            beta = math_formula.computeRelativeAngle(kp[j].angle,-vix,-viy)
-
-            ki = keyIds[i]/1000
-            kj = keyIds[j]/1000
-            if trHandler.dVisualWordIndexCheck[ki,kj]:
-                # temp = trHandler.edgesIndexLSH.query([keyIds[i],keyIds[j],alpha,beta],1)
-                # if temp:
-                #     if temp[0][1] < 1000 and keyIds[i]-temp[0][0][0] == 0 and keyIds[j]-temp[0][0][1] == 0 and abs(alpha-temp[0][0][2]) < 25 and abs(beta-temp[0][0][3]) < 25:
-                        # print keyIds[i],keyIds[j],temp[0][0][0],temp[0][0][1]
-                alphabin = int(alpha)/24
-                betabin = int(beta)/24
-                if (ki,kj,alphabin,betabin) in trHandler.edgeIndexHash or (ki,kj,alphabin+1,betabin) in trHandler.edgeIndexHash or (ki,kj,alphabin,betabin+1) in trHandler.edgeIndexHash or (ki,kj,alphabin-1,betabin) in trHandler.edgeIndexHash or (ki,kj,alphabin,betabin-1) in trHandler.edgeIndexHash or (ki,kj,alphabin+1,betabin+1) in trHandler.edgeIndexHash or (ki,kj,alphabin-1,betabin-1) in trHandler.edgeIndexHash:
-                        matchSimpleEdgePairNum.append([i,j])
-                        matchPointNum.add(i)
-                        matchPointNum.add(j)
-
-        print 'Edge Match Count:',len(matchSimpleEdgePairNum)
-        # Time End
-        tEnd = time.time()
-        print "cost %f sec" % (tEnd - tStart)
-        # matchPointNum = {1,2,3}
-        # matchSimpleEdgePairNum = [[1,2],[1,3],[2,3]]
-
-        tempDict = {i: set() for i in matchPointNum}
-        for i,j in matchSimpleEdgePairNum:
-            tempDict[i].add(j)
-            tempDict[j].add(i)
-
-        tripePointNum = []
-        for i,j in matchSimpleEdgePairNum:
-            tempset = tempDict[i].intersection(tempDict[j])
-            while tempset:
-                temps = {i,j,tempset.pop()}
-                if temps not in tripePointNum:
-                    tripePointNum.append(temps)
-
-        # print tripePointNum
-        # print len(tripePointNum)
+        result = prepared.result
+        stats = prepared.stats = {}
 
-        queryImgTriangles = []
-        while tripePointNum:
-            queryImgTriangles.append(self.createAtriangle(tripePointNum.pop(),kp,keyIds,imgpath))
+        Ids = model.wordAssigner.assign(np.asarray(des))
+        keyIds = Ids*1000
+        record.lap('words')
 
-        # print queryImgTriangles
-        print imgpath,'Possible Triangles Count:',len(queryImgTriangles)
-        self.showTraingle(queryImgTriangles, trHandler, imgpath)
+        pairI,pairJ,alphas,betas = self.sampleEdges(kp,stats)
+        result['pairs'] = len(pairI)
+        record.lap('pairs')
 
-    def showTraingle(self, queryImgTriangles, trHandler, imgpath):
+        n = len(kp)
+        if multi:
+            ki = Ids[pairI]
+            kj = Ids[pairJ]
+            edgeMatch = model.dVisualWordIndexCheck[ki,kj]
+            record.count('wordPairHits',edgeMatch.sum())
+            edgeClasses = np.zeros(len(pairI),np.uint64)
+            edgeClasses[edgeMatch] = model.edgeIndex.classesNear(ki[edgeMatch],kj[edgeMatch],
+                edge_index.angleBins(alphas[edgeMatch]),edge_index.angleBins(betas[edgeMatch]))
+            edgeMatch = edgeClasses != 0
+            pairI = pairI[edgeMatch]
+            pairJ = pairJ[edgeMatch]
+            edgeClasses = edgeClasses[edgeMatch]
+            result['edgeMatches'] = len(pairI)
+            record.lap('edges')
+
+            # Triangles are built from the matched edges of each class
+            # separately, then the union is described and queried once
+            classTriangles = []
+            for classId in range(len(model.logoNames)):
+                inClass = (edgeClasses >> np.uint64(classId)) & np.uint64(1) == 1
+                classTriangles.append(triangle_generator.enumerateTriangles(pairI[inClass],pairJ[inClass],n))
+            prepared.classKeys = [(T[:,0]*n + T[:,1])*n + T[:,2] for T in classTriangles]
+            tripeKeys = np.unique(np.concatenate(prepared.classKeys)) if prepared.classKeys else np.zeros(0,np.int64)
+            prepared.tripeKeys = tripeKeys
+            tripePointNum = np.column_stack((tripeKeys // (n*n),tripeKeys // n % n,tripeKeys % n))
+        else:
+            edgeMatch = self.matchEdges(Ids,pairI,pairJ,alphas,betas,model,record)
+            matchSimpleEdgePairNum = np.column_stack((pairI[edgeMatch],pairJ[edgeMatch]))
+            result['edgeMatches'] = len(matchSimpleEdgePairNum)
+            record.lap('edges')
+
+            tripePointNum = triangle_generator.enumerateTriangles(matchSimpleEdgePairNum[:,0],matchSimpleEdgePairNum[:,1],n)
+        prepared.queryImgTriangles = self.createTriangles(tripePointNum,kp,keyIds,imgpath)
+        result['triangles'] = len(prepared.queryImgTriangles)
+        record.lap('triangles')
+        result['seconds'] = time.time() - tStart
+        return prepared
+
+    def matchPrepared(self,prepared,model):
+        # Queries the triangles of images prepared by prepareMatch and
+        # returns their result dicts. The triangles of all images go into one
+        # query_batch call, where rows of different images that probe the
+        # same buckets are ranked together. Each image is charged the time of
+        # the whole query, its candidates are counted on the first image.
+        multi = isinstance(model, MultiLogoModel)
+        queried = [p for p in prepared if p.queryImgTriangles is not None]
+        for p in queried:
+            p.record.lap('queued')
+        tStart = time.time()
+        queryPoints = [queryImgTriangle[:8] for p in queried for queryImgTriangle in p.queryImgTriangles]
+        queryResults = []
+        if queryPoints:
+            # The nearest trained triangle, of every class for a MultiLogoModel
+            queryResults = model.trianglesIndexLSH.query_batch(queryPoints,1,group_func=classOfValue if multi else None,
+                                                               stats=queried[0].stats,num_probes=self.lshProbes)
+        seconds = time.time() - tStart
+        start = 0
+        for p in queried:
+            end = start + len(p.queryImgTriangles)
+            if multi:
+                self.countClassMatches(p,queryResults[start:end],model)
+            else:
+                p.result['matches'] = self.countMatched(p.queryImgTriangles,queryResults[start:end])
+            start = end
+            p.result['seconds'] += seconds
+            p.record.lap('lsh')
+            self.recordResult(p.record,p.result,p.stats)
+        return [p.result for p in prepared]
+
+    def countClassMatches(self,prepared,queryResults,model):
+        # Fills the match count of every class of a prepared multi logo image
+        queryImgTriangles = prepared.queryImgTriangles
+        # matched[c,t]: the nearest trained triangle of class c matches triangle t
+        matched = np.zeros((len(model.logoNames),len(queryImgTriangles)),bool)
+        for t,queryResult in enumerate(queryResults):
+            for (trainedPoint,(classId,x)),distance in queryResult:
+                matched[classId,t] = self.isTriangleMatch(queryImgTriangles[t],trainedPoint)
+        for classId,logo_name in enumerate(model.logoNames):
+            prepared.result['matches'][logo_name] = int(matched[classId,np.searchsorted(prepared.tripeKeys,prepared.classKeys[classId])].sum())
+
+    def matchCascade(self,kp,Ids,trHandler,thresholds,result,imgpath=None,record=NULL_RECORD,stats=None):
+        # The matching of matchFeatures in rounds of sampled pairs, filling
+        # result. Each round matches its edges, enumerates the triangles of
+        # all edges matched so far and queries those not queried before, a
+        # chunk at a time. Rounds start at cascadeRound pairs and chunks at
+        # cascadeChunk triangles, both double every time so an undecided
+        # image costs few rounds and queries more. More edges only add
+        # triangles, so the image is accepted as soon as the matches reach the
+        # accept threshold, usually within the first rounds for clear
+        # positives. 'matches' then holds the count up to the decision.
+        #
+        # An exact reject has to wait until every pair is sampled, since the
+        # pairs left could still close any number of triangles. It then saves
+        # the queries of the triangles left, not the sampling, so with exact
+        # decisions negatives gain little. With cascadeEstimate = k the image
+        # is also rejected after a round once k*(matches+1)/p is below the
+        # reject threshold: a triangle is found once two of its corners were
+        # visited as anchors, so after a share f of the anchors, visited in
+        # random order, about p = 3f^2 - 2f^3 of the final triangles are
+        # found. This is not exact, a logo whose triangles all lie in the
+        # part not visited yet can be rejected. Clear negatives then stop
+        # after a small part of the pairs.
+        n = len(kp)
+        keyIds = Ids*1000
+        kpPoints = pair_generator.keypointCoordinates(kp)
+        kpAngles = pair_generator.keypointAngles(kp)
+        sampler = pair_generator.NeighbourPairSampler(kpPoints,self.maxPairs,self.maxPairSeconds,self.seed,stats=stats)
+        chunks = sampler.chunks()
+        edgesI = []
+        edgesJ = []
+        queried = np.zeros(0,np.int64)
+        roundSize = self.cascadeRound
+        chunkSize = self.cascadeChunk
+        while True:
+            roundI = []
+            roundJ = []
+            count = 0
+            sampled = False
+            for I,J in chunks:
+                roundI.append(I)
+                roundJ.append(J)
+                count += len(I)
+                if count >= roundSize:
+                    break
+            else:
+                sampled = True
+            roundSize *= 2
+            pairI = np.concatenate(roundI) if roundI else np.zeros(0,np.intp)
+            pairJ = np.concatenate(roundJ) if roundJ else np.zeros(0,np.intp)
+            result['pairs'] += len(pairI)
+            record.lap('pairs')
+
+            alphas,betas = self.edgeAngles(kpPoints,kpAngles,pairI,pairJ)
+            edgeMatch = self.matchEdges(Ids,pairI,pairJ,alphas,betas,trHandler,record)
+            edgesI.append(pairI[edgeMatch])
+            edgesJ.append(pairJ[edgeMatch])
+            result['edgeMatches'] += int(edgeMatch.sum())
+            record.lap('edges')
+
+            T = triangle_generator.enumerateTriangles(np.concatenate(edgesI),np.concatenate(edgesJ),n)
+            keys = (T[:,0].astype(np.int64)*n + T[:,1])*n + T[:,2]
+            new = ~np.in1d(keys,queried)
+            T = T[new]
+            queried = np.union1d(queried,keys[new])
+            result['triangles'] += len(T)
+            record.lap('triangles')
+
+            start = 0
+            while start < len(T):
+                queryImgTriangles = self.createTriangles(T[start:start+chunkSize],kp,keyIds,imgpath)
+                result['matches'] += self.countTriangleMatches(queryImgTriangles,trHandler,stats)
+                start += chunkSize
+                chunkSize *= 2
+                left = max(0,len(T)-start) if sampled else float('inf')
+                result['decision'] = thresholds.decide(result['matches'],result['matches']+left)
+                if result['decision'] is not None:
+                    break
+            record.lap('lsh')
+            if result['decision'] is None and not sampled and self.cascadeEstimate is not None:
+                f = float(sampler.visited)/n
+                p = 3*f*f - 2*f*f*f
+                if p > 0 and thresholds.decide(result['matches'],self.cascadeEstimate*(result['matches']+1)/p) == 'reject':
+                    result['decision'] = 'reject'
+                    if stats is not None:
+                        stats['estimatedRejects'] = stats.get('estimatedRejects',0) + 1
+            if result['decision'] is not None:
+                return
+            if sampled:
+                result['decision'] = thresholds.decide(result['matches'],result['matches'])
+                if stats is not None and not sampler.complete:
+                    stats['pairBudgetHits'] = stats.get('pairBudgetHits',0) + 1
+                return
+
+    def recordResult(self,record,result,stats):
+        # Counters of a matched image, stats holds those of sampleEdges and
+        # the LSH query
+        record.count('pairsExamined',stats.get('pairsExamined',0))
+        record.count('pairsRejectedLength',stats.get('pairsRejectedLength',0))
+        record.count('pairs',result['pairs'])
+        record.count('pairBudgetHits',stats.get('pairBudgetHits',0))
+        record.count('estimatedRejects',stats.get('estimatedRejects',0))
+        record.count('edgeHits',result['edgeMatches'])
+        record.count('triangles',result['triangles'])
+        record.count('lshCandidates',stats.get('candidates',0))
+        if result.get('decision') is not None:
+            record.count({'accept': 'accepted', 'reject': 'rejected'}[result['decision']])
+        if isinstance(result['matches'],dict):
+            record.count('matches',sum(result['matches'].itervalues()))
+        else:
+            record.count('matches',result['matches'])
 
+    def recognize(self,imgpath,trHandler,thresholds=None):
+
+        record = self.instrumentation.begin('recognize',imgpath)
+        kp, des = self.detectFeatures(imgpath)
+        record.lap('sift')
+        result = self.matchFeatures(kp,des,trHandler,imgpath,record,thresholds)
+        self.instrumentation.finish(record)
+
+        print result['pairs']
+        print 'Edge Match Count:',result['edgeMatches']
+        print imgpath,'Possible Triangles Count:',result['triangles']
+        print 'Triangle Feature Match Count:',result['matches']
+        if thresholds is not None:
+            print 'Decision:',result['decision']
+        print "cost %f sec" % result['seconds']
+        self.img_traingle_counter[imgpath] = result['matches']
+        return result
+
+    def isTriangleMatch(self,queryImgTriangle,trainedPoint):
+        return queryImgTriangle[0] == trainedPoint[0] and queryImgTriangle[1] == trainedPoint[1] and queryImgTriangle[2] == trainedPoint[2] and abs(queryImgTriangle[3] - trainedPoint[3]) < 10 and abs(queryImgTriangle[4] - trainedPoint[4]) < 10 and abs(queryImgTriangle[5] - trainedPoint[5]) < 24 and abs(queryImgTriangle[6] - trainedPoint[6]) < 24 and abs(queryImgTriangle[7] - trainedPoint[7]) < 24
+
+    def countTriangleMatches(self, queryImgTriangles, trHandler, stats=None):
+        # Number of query triangles whose nearest trained triangle matches
+        queryPoints = [queryImgTriangle[:8] for queryImgTriangle in queryImgTriangles]
+        queryResults = trHandler.trianglesIndexLSH.query_batch(queryPoints,1,stats=stats,num_probes=self.lshProbes)
+        return self.countMatched(queryImgTriangles,queryResults)
+
+    def countMatched(self, queryImgTriangles, queryResults):
+        # countTriangleMatches of the query_batch results of the triangles
         matchCount = 0
-        for i in range(len(queryImgTriangles)):
-            queryResult = trHandler.trianglesIndexLSH.query([queryImgTriangles[i][0],queryImgTriangles[i][1],queryImgTriangles[i][2],queryImgTriangles[i][3],queryImgTriangles[i][4],queryImgTriangles[i][5],queryImgTriangles[i][6],queryImgTriangles[i][7]],1)
+        for i,queryResult in enumerate(queryResults):
             # print queryResult
             # print queryImgTriangles[i]
             if queryResult:
                 # if queryImgTriangles[i][0] == queryResult[0][0][0][0] and queryImgTriangles[i][1] == queryResult[0][0][0][1] and queryImgTriangles[i][2] == queryResult[0][0][0][2] and queryResult[0][1] < 1352:
-                if queryImgTriangles[i][0] == queryResult[0][0][0][0] and queryImgTriangles[i][1] == queryResult[0][0][0][1] and queryImgTriangles[i][2] == queryResult[0][0][0][2] and abs(queryImgTriangles[i][3] - queryResult[0][0][0][3]) < 10 and abs(queryImgTriangles[i][4] - queryResult[0][0][0][4]) < 10 and abs(queryImgTriangles[i][5] - queryResult[0][0][0][5]) < 24 and abs(queryImgTriangles[i][6] - queryResult[0][0][0][6]) < 24 and abs(queryImgTriangles[i][7] - queryResult[0][0][0][7]) < 24:
+                if self.isTriangleMatch(queryImgTriangles[i],queryResult[0][0][0]):
                     # self.drawTrianglePair(queryImgTriangles[i],trHandler.trianglePositionList[int(queryResult[0][0][1])])
                     matchCount = matchCount + 1
                     # print queryResult[0][0][1]
+        return matchCount
 
+    def showTraingle(self, queryImgTriangles, trHandler, imgpath):
+
+        matchCount = self.countTriangleMatches(queryImgTriangles, trHandler)
         print 'Triangle Feature Match Count:',matchCount
         self.img_traingle_counter[imgpath] = matchCount
 
+    def matchFeaturesAll(self,kp,des,model,imgpath=None,record=None):
+        # matchFeatures against every class of a MultiLogoModel. Features,
+        # pairs and triangle queries are computed once, 'matches' holds the
+        # triangle match count of every logo class.
+        ownRecord = record is None
+        if ownRecord:
+            record = self.instrumentation.begin('recognizeAll',imgpath)
+        result = self.matchPrepared([self.prepareMatch(kp,des,model,imgpath,record)],model)[0]
+        if ownRecord:
+            self.instrumentation.finish(record)
+        return result
+
+    def recognizeAll(self,imgpath,model):
+        # Matches one image against every class of a MultiLogoModel, returns
+        # the triangle match count of every logo class
+        record = self.instrumentation.begin('recognizeAll',imgpath)
+        kp, des = self.detectFeatures(imgpath)
+        record.lap('sift')
+        result = self.matchFeaturesAll(kp,des,model,imgpath,record)
+        self.instrumentation.finish(record)
+
+        print result['pairs']
+        print 'Edge Match Count:',result['edgeMatches']
+        print imgpath,'Possible Triangles Count:',result['triangles']
+        print "cost %f sec" % result['seconds']
+        return result['matches']
+
+    def recognize_batch(self, imgpaths, model, siftWorkers=2, matchWorkers=2, queueSize=8, thresholds=None):
+        # Recognizes many images and returns their result dicts (see
+        # matchFeatures) in the order of imgpaths. An image is a path or a
+        # (name, encoded image bytes) tuple. model is a TrainingHandler
+        # or a MultiLogoModel. Reading and decoding, SIFT and matching up to
+        # the LSH query run as pipeline stages in their own threads with
+        # bounded queues between them, SIFT and most of matching run in
+        # cv2/numpy without the GIL. The triangles of all images are then
+        # queried at once, see matchPrepared, so the images of one call
+        # should fit in memory together. Images with cached features skip
+        # decoding and SIFT. A failing image gets its error in the result, the
+        # others go on. thresholds are the CascadeThresholds of a
+        # TrainingHandler class, the cascade queries every image on its own.
+        cache = feature_cache.sharedCache()
+        if isinstance(model, MultiLogoModel):
+            if thresholds is not None:
+                raise ValueError('cascade thresholds need a single class model')
+            kind = 'recognizeAll'
+        else:
+            kind = 'recognize'
+
+        def decode(imgpath):
+            if isinstance(imgpath,tuple):
+                imgpath,data = imgpath
+            else:
+                fh = open(imgpath,'rb')
+                try:
+                    data = fh.read()
+                finally:
+                    fh.close()
+            key = cache.cacheKeyOfData(data)
+            found = cache.lookup(key)
+            if found is not None:
+                return imgpath,key,None,found
+            img = cv2.imdecode(np.frombuffer(data,np.uint8),1)
+            if img is None:
+                raise IOError('cannot decode %s' % imgpath)
+            return imgpath,key,img,None
+
+        def sift(item):
+            imgpath,key,img,found = item
+            record = self.instrumentation.begin(kind,imgpath)
+            if found is None:
+                found = cache.compute(img)
+                cache.store(key,*found)
+            record.lap('sift')
+            return imgpath,found,record
+
+        def matchImage(item):
+            imgpath,(points,des),record = item
+            record.lap('queued')
+            kp,des = cache.unpack(points,des)
+            if thresholds is None:
+                try:
+                    return self.prepareMatch(kp,des,model,imgpath,record)
+                except Exception:
+                    self.instrumentation.finish(record)
+                    raise
+            try:
+                return self.matchFeatures(kp,des,model,imgpath,record,thresholds)
+            finally:
+                self.instrumentation.finish(record)
+
+        outputs = pipeline.runPipeline(imgpaths,[
+            ('decode',decode,1),
+            ('sift',sift,siftWorkers),
+            ('match',matchImage,matchWorkers)],queueSize)
+
+        if thresholds is None:
+            prepared = [output for output in outputs if not isinstance(output,pipeline.StageError)]
+            try:
+                self.matchPrepared(prepared,model)
+            finally:
+                for p in prepared:
+                    self.instrumentation.finish(p.record)
+            outputs = [output if isinstance(output,pipeline.StageError) else output.result for output in outputs]
+
+        results = []
+        for imgpath,output in zip(imgpaths,outputs):
+            if isinstance(output,pipeline.StageError):
+                if isinstance(imgpath,tuple):
+                    imgpath = imgpath[0]
+                result = self.emptyResult(imgpath)
+                if isinstance(model, MultiLogoModel):
+                    result['matches'] = dict((logo_name,0) for logo_name in model.logoNames)
+                result['error'] = '%s: %r' % (output.stage,output.exc_info[1])
+                output = result
+            results.append(output)
+        return results
+
     def showImgTriangleCounter(self):
         for key in self.img_traingle_counter:
             print key, self.img_traingle_counter[key]
@@ -0,0 +1,116 @@
+import os
+import time
+import multiprocessing
+
+from training_handler import TrainingHandler
+from feature_storage import FeatureStorage
+
+try:
+    import resource
+except ImportError:
+    # no per-worker memory cap on platforms without it
+    resource = None
+
+
+def _init_class_worker(memoryLimitMB):
+    if memoryLimitMB and resource is not None:
+        limit = int(memoryLimitMB) << 20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def _class_training_job(job):
+    logo_name, trainingPaths, vocabularyBuilder = job
+    tStart = time.time()
+    try:
+        # a fresh handler, retraining must not append to the old model
+        trHandler = TrainingHandler(logo_name, load_model=False)
+        trHandler.training_imageSet(trainingPaths, vocabularyBuilder=vocabularyBuilder)
+        writeStamp(logo_name, trainingPaths)
+    except MemoryError:
+        return logo_name, 'out of memory', time.time() - tStart
+    except Exception as e:
+        return logo_name, 'failed: %r' % (e,), time.time() - tStart
+    return logo_name, 'trained', time.time() - tStart
+
+
+def stampPath(logo_name):
+    return FeatureStorage(logo_name).modelPath() + '.stamp'
+
+def trainingStamp(trainingPaths):
+    # Identifies the training set a model was built from, the image paths
+    # together with their size and modification time
+    stamp = []
+    for path in sorted(trainingPaths):
+        st = os.stat(path)
+        stamp.append((path, st.st_size, int(st.st_mtime)))
+    return repr(stamp)
+
+def writeStamp(logo_name, trainingPaths):
+    # written after the model, renamed into place like the model itself
+    path = stampPath(logo_name)
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    fh = open(tmpPath, 'w')
+    try:
+        fh.write(trainingStamp(trainingPaths))
+    finally:
+        fh.close()
+    os.rename(tmpPath, path)
+
+def isUpToDate(logo_name, trainingPaths):
+    if not os.path.isfile(FeatureStorage(logo_name).modelPath()) or not os.path.isfile(stampPath(logo_name)):
+        return False
+    fh = open(stampPath(logo_name), 'r')
+    try:
+        return fh.read() == trainingStamp(trainingPaths)
+    finally:
+        fh.close()
+
+
+class TrainingDriver:
+    # Trains several logo classes concurrently, one class per worker process.
+    # Classes with the most training images start first so the long ones do
+    # not end up running alone at the end. Classes whose model was built from
+    # the current training images are skipped.
+    def __init__(self, getImagePath, workers=None, memoryLimitMB=None, force=False, vocabularyBuilder=None):
+        self.getImagePath = getImagePath
+        self.workers = workers or multiprocessing.cpu_count()
+        # address space limit of each worker, a class that runs out of memory
+        # fails alone instead of taking the machine down
+        self.memoryLimitMB = memoryLimitMB
+        self.force = force
+        # passed to TrainingHandler.training_imageSet, None for its default
+        self.vocabularyBuilder = vocabularyBuilder
+
+    def schedule(self, logo_classes):
+        # (logo_name, trainingPaths, vocabularyBuilder) jobs, largest class
+        # first. Pairs are trained for every ordered image pair, so the cost
+        # grows with n*n.
+        jobs = []
+        for logo_name in logo_classes:
+            trainingPaths = self.getImagePath.getImagePath(logo_name,1)
+            if not self.force and isUpToDate(logo_name, trainingPaths):
+                print 'Logo:', logo_name, 'up to date'
+                continue
+            jobs.append((logo_name, trainingPaths, self.vocabularyBuilder))
+        jobs.sort(key=lambda job: len(job[1]), reverse=True)
+        return jobs
+
+    def train(self, logo_classes):
+        # returns {logo_name: status} of the trained classes
+        jobs = self.schedule(logo_classes)
+        results = {}
+        if len(jobs) == 0:
+            return results
+
+        tStart = time.time()
+        # one class per worker process, the memory of a class is given back
+        # to the system when it is done
+        pool = multiprocessing.Pool(min(self.workers, len(jobs)), _init_class_worker, (self.memoryLimitMB,), maxtasksperchild=1)
+        try:
+            for logo_name, status, cost in pool.imap_unordered(_class_training_job, jobs):
+                print 'Logo:', logo_name, status, 'cost %f sec' % cost
+                results[logo_name] = status
+        finally:
+            pool.close()
+            pool.join()
+        print 'trained %d classes, cost %f sec' % (len(jobs), time.time() - tStart)
+        return results
@@ -1,17 +1,47 @@
 import cv2
 import numpy as np
-from math import atan, degrees, exp, acos, sqrt
-from scipy.cluster.vq import vq, kmeans
 from lshash import LSHash
+import math_formula
+import pair_generator
+import triangle_generator
+import edge_index
+import feature_cache
+import vocabulary
 import time
+import threading
+import multiprocessing
 
+import model_format
+from instrumentation import sharedInstrumentation
 from feature_storage import FeatureStorage
 from os.path import isfile
 
+# Model attributes that a handler opened on a model file reads on first use
+_MODEL_ATTRIBUTES = ('trianglePositionList','trainedDescriptorsList','centroidsOfKmean2000',
+    'visualWordLabelIDs','trianglesIndexLSH','triangleVWwith6anglesFeatureList',
+    'dVisualWordIndexCheck','edgeIndexHash','wordAssigner','trainedImagePaths')
+
+# Threads sharing a handler load each model attribute once
+_modelLoadLock = threading.RLock()
+
+# Handler of a pair training worker process, see training_imageSet
+_pairWorker = None
+
+def _init_pair_worker(logo_name):
+    global _pairWorker
+    _pairWorker = TrainingHandler(logo_name, load_model=False)
+
+def _pair_training_job(paths):
+    return _pairWorker.pair_training(paths[0], paths[1])
+
 class TrainingHandler():
-    def __init__(self, logo_name):
+    def __init__(self, logo_name, load_model=True, instrumentation=None):
 
         self.logo_name = logo_name
+        # counters and stage timings of trained pairs and training runs, see
+        # instrumentation.py. Pool workers record into the instrumentation
+        # of their own process.
+        self.instrumentation = instrumentation or sharedInstrumentation()
 
         # FLANN parameters
         FLANN_INDEX_KDTREE = 0
@@ -28,8 +58,15 @@ class TrainingHandler():
 
         # Only Use for showing triangle compared image
 
-        if isfile('../model/' + logo_name + '.pkl'):
-            FS = FeatureStorage(logo_name)
+        FS = FeatureStorage(logo_name)
+        if load_model and isfile(FS.modelPath()):
+            # Only the header is read here, every model attribute is mapped
+            # from the file when it is first used (see __getattr__), so
+            # recognition never loads the triangle positions or descriptors
+            self.modelFile = FS.openArrays()
+
+        elif load_model and isfile(FS.picklePath()):
+            # Pickled model of an earlier version, save_model migrates it
             data = FS.load()
 
             (self.trianglePositionList,
@@ -39,17 +76,120 @@ class TrainingHandler():
             self.trianglesIndexLSH,\
             self.triangleVWwith6anglesFeatureList,\
             self.dVisualWordIndexCheck,\
-            self.edgeIndexHash) = data
+            self.edgeIndexHash) = data[:8]
+
+            # Models saved before the vocabulary tree get one built on load
+            if len(data) > 8:
+                self.wordAssigner = data[8]
+            else:
+                self.wordAssigner = vocabulary.VocabularyTree(self.centroidsOfKmean2000[0])
+
+            # The trained images were not kept, those with triangles are known
+            self.trainedImagePaths = self.triangleImagePaths()
+
+            # Models saved before the packed indexes keep a dict and a dense matrix
+            if isinstance(self.edgeIndexHash,dict):
+                self.edgeIndexHash = edge_index.EdgeIndex.fromTuples(self.edgeIndexHash.keys())
+            if isinstance(self.dVisualWordIndexCheck,np.ndarray):
+                self.dVisualWordIndexCheck = edge_index.WordPairIndex.fromMatrix(self.dVisualWordIndexCheck)
 
         else:
             self.trianglePositionList = []
             self.trainedDescriptorsList = []
             self.centroidsOfKmean2000 = tuple()
             self.visualWordLabelIDs = []
-            self.trianglesIndexLSH = LSHash(32, 8)
+            self.trianglesIndexLSH = LSHash(32, 8, storage_config={'array': None})
             self.triangleVWwith6anglesFeatureList = []
-            self.dVisualWordIndexCheck = np.zeros((2000,2000),bool)
-            self.edgeIndexHash = dict()
+            self.dVisualWordIndexCheck = edge_index.WordPairIndex()
+            self.edgeIndexHash = edge_index.EdgeIndex()
+            self.wordAssigner = None
+            self.trainedImagePaths = []
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set yet
+        if name in _MODEL_ATTRIBUTES and 'modelFile' in self.__dict__:
+            with _modelLoadLock:
+                if name not in self.__dict__:
+                    self.__dict__[name] = self.load_attribute(name)
+                return self.__dict__[name]
+        raise AttributeError(name)
+
+    def load_attribute(self, name):
+        modelFile = self.modelFile
+        if name == 'trianglePositionList':
+            imagePaths = [str(path) for path in modelFile.meta['imagePaths']]
+            positions = modelFile.array('trianglePositions').tolist()
+            imageIds = modelFile.array('triangleImageIds').tolist()
+            return [[(p[0],p[1]),(p[2],p[3]),(p[4],p[5]),imagePaths[i]] for p,i in zip(positions,imageIds)]
+        if name == 'trainedDescriptorsList':
+            return list(modelFile.array('trainedDescriptors'))
+        if name == 'centroidsOfKmean2000':
+            return (modelFile.array('centroids'),modelFile.meta['distortion'])
+        if name == 'visualWordLabelIDs':
+            return modelFile.array('visualWordLabelIDs').tolist()
+        if name == 'trianglesIndexLSH':
+            return model_format.lshFromArrays(modelFile.arrays('trianglesIndexLSH'),modelFile.meta['trianglesIndexLSH'])
+        if name == 'triangleVWwith6anglesFeatureList':
+            return modelFile.array('triangleFeatures').tolist()
+        if name == 'dVisualWordIndexCheck':
+            return edge_index.WordPairIndex.fromArrays(modelFile.arrays('dVisualWordIndexCheck'))
+        if name == 'edgeIndexHash':
+            return edge_index.EdgeIndex.fromArrays(modelFile.arrays('edgeIndexHash'))
+        if name == 'trainedImagePaths':
+            if 'trainedImagePaths' in modelFile.meta:
+                return [str(path) for path in modelFile.meta['trainedImagePaths']]
+            return [str(path) for path in modelFile.meta['imagePaths']]
+        if name == 'wordAssigner':
+            return vocabulary.VocabularyTree.fromArrays(modelFile.arrays('wordAssigner'),
+                modelFile.meta['wordAssignerProbes'],modelFile.meta['wordAssignerAgreement'])
+        raise AttributeError(name)
+
+    def triangleImagePaths(self):
+        # Images that have triangles in the model, in order of appearance
+        imagePaths = []
+        seen = set()
+        for position in self.trianglePositionList:
+            if position[3] not in seen:
+                seen.add(position[3])
+                imagePaths.append(position[3])
+        return imagePaths
+
+    def save_model(self):
+        # Writes the model in the array format of model_format.py
+        imagePaths = []
+        imageIdOfPath = {}
+        positions = []
+        imageIds = []
+        for pti,ptj,ptk,imgpath in self.trianglePositionList:
+            if imgpath not in imageIdOfPath:
+                imageIdOfPath[imgpath] = len(imagePaths)
+                imagePaths.append(imgpath)
+            positions.append([pti[0],pti[1],ptj[0],ptj[1],ptk[0],ptk[1]])
+            imageIds.append(imageIdOfPath[imgpath])
+
+        lshArrays,lshMeta = model_format.lshArrays(self.trianglesIndexLSH)
+        arrays = {
+            'trianglePositions': np.asarray(positions,float).reshape(-1,6),
+            'triangleImageIds': np.asarray(imageIds,np.int32),
+            'trainedDescriptors': np.asarray(self.trainedDescriptorsList,np.float32).reshape(-1,128),
+            'centroids': np.asarray(self.centroidsOfKmean2000[0]),
+            'visualWordLabelIDs': np.asarray(self.visualWordLabelIDs,np.int32),
+            'triangleFeatures': np.asarray(self.triangleVWwith6anglesFeatureList,float).reshape(-1,11)}
+        arrays.update(model_format.prefixed('trianglesIndexLSH',lshArrays))
+        arrays.update(model_format.prefixed('dVisualWordIndexCheck',self.dVisualWordIndexCheck.toArrays()))
+        arrays.update(model_format.prefixed('edgeIndexHash',self.edgeIndexHash.toArrays()))
+        arrays.update(model_format.prefixed('wordAssigner',self.wordAssigner.toArrays()))
+        meta = {
+            'logo_name': self.logo_name,
+            'imagePaths': imagePaths,
+            'trainedImagePaths': self.trainedImagePaths,
+            'distortion': float(self.centroidsOfKmean2000[1]),
+            'trianglesIndexLSH': lshMeta,
+            'wordAssignerProbes': self.wordAssigner.probes,
+            'wordAssignerAgreement': self.wordAssigner.agreementRate}
+
+        FS = FeatureStorage(self.logo_name)
+        FS.saveArrays('TrainingHandler',arrays,meta)
 
     def drawKeyPoints(self, img1, img2, keypoints1, keypoints2, num=-1):
         h1, w1 = img1.shape[:2]
@@ -72,32 +212,7 @@ class TrainingHandler():
         cv2.destroyAllWindows()
 
     def compute_relative_angle(self, siftangle, vx, vy):
-        angle = 0.0
-        rangle = 0.0
-        if vx > 0 and vy >= 0:
-            angle = degrees(atan(vy/vx))
-        elif vx == 0 and vy == 0:
-            angle = 0.0
-        elif vx == 0 and vy > 0:
-            angle = 90.0
-        elif vx < 0 and vy > 0:
-            angle = 90.0 + degrees(atan(-vx/vy))
-        elif vx < 0 and vy == 0:
-            angle = 180.0
-        elif vx < 0 and vy < 0:
-            angle = 180.0 + degrees(atan(vy/vx))
-        elif vx == 0 and vy < 0:
-            angle = 270.0
-        elif vx > 0 and vy < 0:
-            angle = 270.0 + degrees(atan(vx/-vy))
-        else:
-            print 'bugs here'
-
-        if (360.0 - siftangle) > angle:
-            rangle = (360.0 - siftangle) - angle
-        else:
-            rangle = 360 - (angle - (360.0 - siftangle))
-        return rangle
+        return math_formula.computeRelativeAngle(siftangle, vx, vy)
 
     def generate_EdgeIndexArray_IndexInEdge(self, keypoints1, keypoints2):
         kpLength = len(keypoints1)
@@ -109,119 +224,80 @@ class TrainingHandler():
         # [ 60.,  0.,  0.]
         # [ 60.,  0.,  0.]
         kpIndexOfEdgeAngleArray = np.zeros((kpLength,kpLength),float)
+
+        # Change coordinate to:->x ^y (opencv:->x vy)
+        # All pairs at once: entry [i,j] of each matrix belongs to edge i------j
+        pts1 = pair_generator.keypointCoordinates(keypoints1)
+        pts2 = pair_generator.keypointCoordinates(keypoints2)
+        angles1 = pair_generator.keypointAngles(keypoints1)
+        angles2 = pair_generator.keypointAngles(keypoints2)
+        vix = pts1[np.newaxis,:,0] - pts1[:,np.newaxis,0]
+        viy = pts1[:,np.newaxis,1] - pts1[np.newaxis,:,1]
+        vixp = pts2[np.newaxis,:,0] - pts2[:,np.newaxis,0]
+        viyp = pts2[:,np.newaxis,1] - pts2[np.newaxis,:,1]
+        alpha = math_formula.computeRelativeAngles(angles1[:,np.newaxis],vix,viy)
+        beta = math_formula.computeRelativeAngles(angles1[np.newaxis,:],-vix,-viy)
+        alphap = math_formula.computeRelativeAngles(angles2[:,np.newaxis],vixp,viyp)
+        betap = math_formula.computeRelativeAngles(angles2[np.newaxis,:],-vixp,-viyp)
+
+        dalpha = np.abs(alpha - alphap)
+        dbeta = np.abs(beta - betap)
+        simedge = np.exp(-dalpha*dalpha/128) * np.exp(-dbeta*dbeta/128)
+        # Only i < j, in the same row-major order as the former double loop
+        I,J = np.nonzero(np.triu(simedge > self.SIM_THRESHOLD,1))
+        kpIndexOfEdgeAngleArray[I,J] = alpha[I,J]
+        kpIndexOfEdgeAngleArray[J,I] = beta[I,J]
+
         # ex:kpIndexOfInEdge={13,23,31,34} i=13,23,31,34 are in edges,keypoints1[i]
-        kpIndexOfInEdge = set()
-        indexOfEdgePairs = []
-        for i in range(kpLength-1):
-            for j in range(i+1,kpLength):
-                # Change coordinate to:->x ^y (opencv:->x vy)
-                ix = keypoints1[i].pt[0]
-                iy = -keypoints1[i].pt[1]
-                jx = keypoints1[j].pt[0]
-                jy = -keypoints1[j].pt[1]
-
-                vix = float(jx - ix)
-                viy = float(jy - iy)
-                # vjx = -vix
-                # vjy = -viy
-                alpha = self.compute_relative_angle(keypoints1[i].angle,vix,viy)
-                beta = self.compute_relative_angle(keypoints1[j].angle,-vix,-viy)
-                ixp = keypoints2[i].pt[0]
-                iyp = -keypoints2[i].pt[1]
-                jxp = keypoints2[j].pt[0]
-                jyp = -keypoints2[j].pt[1]
-                vixp = float(jxp - ixp)
-                viyp = float(jyp - iyp)
-                alphap = self.compute_relative_angle(keypoints2[i].angle,vixp,viyp)
-                betap = self.compute_relative_angle(keypoints2[j].angle,-vixp,-viyp)
-
-                dalpha = abs(alpha - alphap)
-                dbeta = abs(beta - betap)
-                simedge = exp(-dalpha*dalpha/128) * exp(-dbeta*dbeta/128)
-                if simedge > self.SIM_THRESHOLD:
-                    kpIndexOfEdgeAngleArray[i,j] = alpha
-                    kpIndexOfEdgeAngleArray[j,i] = beta
-                    kpIndexOfInEdge.add(i)
-                    kpIndexOfInEdge.add(j)
-                    indexOfEdgePairs.append([i,j])
+        kpIndexOfInEdge = set(I.tolist()) | set(J.tolist())
+        indexOfEdgePairs = [[i,j] for i,j in zip(I.tolist(),J.tolist())]
 
         return kpIndexOfEdgeAngleArray,list(kpIndexOfInEdge),indexOfEdgePairs
 
     def create_triangles(self,indexOfEdgeAngle,indexInEdge,indexOfEdgePairs,keypoints,descriptors,imgpath):
-        kpIndexOfInTriangle = set()
+        # Change coordinate to:->x ^y (opencv:->x vy)
+        points = pair_generator.keypointCoordinates(keypoints)
+        points[:,1] = -points[:,1]
+        edges = np.asarray(indexOfEdgePairs,np.intp).reshape(-1,2)
+        triangles = triangle_generator.enumerateTriangles(edges[:,0],edges[:,1],len(keypoints))
+
+        # Add some constraints for generating triangles
+        keep,delta1,delta2 = triangle_generator.triangleConstraintMask(points,triangles,
+            self.TRIANGLE_CONSTRAINT_DIST,
+            self.TRIANGLE_CONSTRAINT_ANGLE,
+            self.TRIANGLE_CONSTRAINT_ECCENTRICITY_LOWERBOUND,
+            self.TRIANGLE_CONSTRAINT_ECCENTRICITY_UPPERBOUND)
+        I,J,K = triangles[:,0],triangles[:,1],triangles[:,2]
+        keep &= (indexOfEdgeAngle[I,J] != 0.0) & (indexOfEdgeAngle[J,K] != 0.0) & (indexOfEdgeAngle[K,I] != 0.0)
+        triangles = triangles[keep]
+        delta1 = delta1[keep]
+        delta2 = delta2[keep]
+
+        kpIndexOfInTriangle = set(triangles.ravel().tolist())
         key3indexandDegreesofTriangle = list()
-
-        indexHavePairDict = {i: set() for i in indexInEdge}
-        for i,j in indexOfEdgePairs:
-            indexHavePairDict[i].add(j)
-            indexHavePairDict[j].add(i)
-        tripleListSet = []
-        for i,j in indexOfEdgePairs:
-            tempset = indexHavePairDict[i].intersection(indexHavePairDict[j])
-            while tempset:
-                temps = {i,j,tempset.pop()}
-                if temps not in tripleListSet:
-                    tripleListSet.append(temps)
-        for keyindexi,keyindexj,keyindexk in tripleListSet:
-            ix = keypoints[keyindexi].pt[0]
-            iy = -keypoints[keyindexi].pt[1]
-            jx = keypoints[keyindexj].pt[0]
-            jy = -keypoints[keyindexj].pt[1]
-            kx = keypoints[keyindexk].pt[0]
-            ky = -keypoints[keyindexk].pt[1]
-            vikx = float(kx - ix)
-            viky = float(ky - iy)
-            vijx = float(jx - ix)
-            vijy = float(jy - iy)
-            length_vik = sqrt(abs(vikx*vikx+viky*viky))
-            length_vij = sqrt(abs(vijx*vijx+vijy*vijy))
-            # Add some constraints for generating triangles
-            if length_vik < self.TRIANGLE_CONSTRAINT_DIST or length_vij < self.TRIANGLE_CONSTRAINT_DIST or length_vij/length_vik < self.TRIANGLE_CONSTRAINT_ECCENTRICITY_LOWERBOUND or length_vij/length_vik > self.TRIANGLE_CONSTRAINT_ECCENTRICITY_UPPERBOUND:
-                continue
-            vcos = (vikx*vijx+viky*vijy)/length_vik/length_vij
-            delta1 = degrees(acos(round(vcos,13)))
-            if delta1 < self.TRIANGLE_CONSTRAINT_ANGLE:
-                continue
-            vjkx = float(kx - jx)
-            vjky = float(ky - jy)
-            vjix = -vijx
-            vjiy = -vijy
-            length_vjk = sqrt(abs(vjkx*vjkx+vjky*vjky))
-            length_vji = sqrt(abs(vjix*vjix+vjiy*vjiy))
-            if length_vjk < self.TRIANGLE_CONSTRAINT_DIST or length_vji < self.TRIANGLE_CONSTRAINT_DIST or length_vjk/length_vji < self.TRIANGLE_CONSTRAINT_ECCENTRICITY_LOWERBOUND or length_vjk/length_vji > self.TRIANGLE_CONSTRAINT_ECCENTRICITY_UPPERBOUND:
-                continue
-            vcos = (vjkx*vjix+vjky*vjiy)/length_vjk/length_vji
-            delta2 = degrees(acos(round(vcos,13)))
-            if delta2 < self.TRIANGLE_CONSTRAINT_ANGLE:
-                continue
-
-            edgeij_anglei = indexOfEdgeAngle[keyindexi,keyindexj]
-            edgejk_anglej = indexOfEdgeAngle[keyindexj,keyindexk]
-            edgeik_anglek = indexOfEdgeAngle[keyindexk,keyindexi]
-            if edgeij_anglei == 0.0 or edgejk_anglej == 0.0 or edgeik_anglek == 0.0:
-                continue
-
-            kpIndexOfInTriangle.add(keyindexi)
-            kpIndexOfInTriangle.add(keyindexj)
-            kpIndexOfInTriangle.add(keyindexk)
-
+        trianglePositions = list()
+        for (keyindexi,keyindexj,keyindexk),d1,d2 in zip(triangles.tolist(),delta1.tolist(),delta2.tolist()):
             # self.trianglePositionList.append([descriptors[keyindexi],descriptors[keyindexj],descriptors[keyindexk],delta1,delta2,edgeij_anglei,edgejk_anglej,edgeik_anglek,keypoints[keyindexi],keypoints[keyindexj],keypoints[keyindexk],imgpath])
-            self.trianglePositionList.append([keypoints[keyindexi].pt,keypoints[keyindexj].pt,keypoints[keyindexk].pt,imgpath])
+            trianglePositions.append([keypoints[keyindexi].pt,keypoints[keyindexj].pt,keypoints[keyindexk].pt,imgpath])
+            key3indexandDegreesofTriangle.append([keyindexi,keyindexj,keyindexk,d1,d2])
 
-            key3indexandDegreesofTriangle.append([keyindexi,keyindexj,keyindexk,delta1,delta2])
-
-        return kpIndexOfInTriangle,key3indexandDegreesofTriangle
+        return kpIndexOfInTriangle,key3indexandDegreesofTriangle,trianglePositions
 
     def image_training(self, img1path, img2path):
-        img1 = cv2.imread(img1path) # 1:queryImage is going to be trained
-        img2 = cv2.imread(img2path) # 2:trainImage trains queryImage
-
-        # Initiate SIFT detector
-        sift = cv2.SIFT()
-
-        # find the keypoints and descriptors with SIFT
-        kp1, des1 = sift.detectAndCompute(img1,None)
-        kp2, des2 = sift.detectAndCompute(img2,None)
+        self.merge_pair_training(self.pair_training(img1path, img2path))
+
+    def pair_training(self, img1path, img2path):
+        # Trains img1path against img2path without touching the model. Returns
+        # the triangle positions, the descriptors of the keypoints in triangles
+        # and the triangle features, whose descriptor ids start at 0.
+        # 1:queryImage is going to be trained
+        # 2:trainImage trains queryImage
+        record = self.instrumentation.begin('pair_training',img1path)
+        # find the keypoints and descriptors with SIFT, each image is extracted once
+        kp1, des1 = feature_cache.sharedCache().detectAndCompute(img1path)
+        kp2, des2 = feature_cache.sharedCache().detectAndCompute(img2path)
+        record.lap('sift')
+        record.count('keypoints',len(kp1)+len(kp2))
 
         matches = self.flann.knnMatch(des1,des2,k=2)
         matches = sorted(matches, key = lambda x:x[0].distance)
@@ -235,6 +311,8 @@ class TrainingHandler():
                 i = i + 1
             indexm = indexm + 1
         # print i,indexm
+        record.lap('match')
+        record.count('goodMatches',len(goodmatches))
 
         # Need only good matches
         # matches = self.flann.knnMatch(des1,des2,k=2)
@@ -268,12 +346,14 @@ class TrainingHandler():
         # self.drawKeyPoints(img1,img2,goodkeypoints1,goodkeypoints2)
 
         edgeIndexArray,indexInEdge,indexOfEdgePairs = self.generate_EdgeIndexArray_IndexInEdge(goodkeypoints1,goodkeypoints2)
-        kpIndexOfInTriangle,key3indexandDegreesofTriangle = self.create_triangles(edgeIndexArray,indexInEdge,indexOfEdgePairs,goodkeypoints1,goodkeydes1,img1path)
-        indexOfIDstartPosition = len(self.trainedDescriptorsList)
-        for keyindex in kpIndexOfInTriangle:
-            self.trainedDescriptorsList.append(goodkeydes1[keyindex])
-        keyInTriangleLabelIDDict = dict(zip(list(kpIndexOfInTriangle), range(indexOfIDstartPosition,indexOfIDstartPosition+len(kpIndexOfInTriangle))))
-
+        record.lap('edges')
+        kpIndexOfInTriangle,key3indexandDegreesofTriangle,trianglePositions = self.create_triangles(edgeIndexArray,indexInEdge,indexOfEdgePairs,goodkeypoints1,goodkeydes1,img1path)
+        record.lap('triangles')
+        kpIndexOfInTriangle = sorted(kpIndexOfInTriangle)
+        descriptors = [goodkeydes1[keyindex] for keyindex in kpIndexOfInTriangle]
+        keyInTriangleLabelIDDict = dict(zip(kpIndexOfInTriangle, range(len(kpIndexOfInTriangle))))
+
+        features = []
         for x in range(len(key3indexandDegreesofTriangle)):
             i = key3indexandDegreesofTriangle[x][0]
             j = key3indexandDegreesofTriangle[x][1]
@@ -286,70 +366,128 @@ class TrainingHandler():
             edgeij_anglej = edgeIndexArray[j,i]
             edgejk_anglek = edgeIndexArray[k,j]
             edgeik_anglei = edgeIndexArray[i,k]
-            self.triangleVWwith6anglesFeatureList.append([keyInTriangleLabelIDDict[i],keyInTriangleLabelIDDict[j],keyInTriangleLabelIDDict[k],delta1,delta2,alpha,beta,gamma,edgeij_anglej,edgejk_anglek,edgeik_anglei])
-
-    def generate_EdgeandTriangle_LSH(self):
-        x=0
-        for i,j,k,delta1,delta2,edgeij_anglei,edgejk_anglej,edgeik_anglek,edgeij_anglej,edgejk_anglek,edgeik_anglei in self.triangleVWwith6anglesFeatureList:
-            vi = self.visualWordLabelIDs[i]
-            vj = self.visualWordLabelIDs[j]
-            vk = self.visualWordLabelIDs[k]
-            self.dVisualWordIndexCheck[vi,vj] = True
-            self.dVisualWordIndexCheck[vj,vi] = True
-            self.dVisualWordIndexCheck[vj,vk] = True
-            self.dVisualWordIndexCheck[vk,vj] = True
-            self.dVisualWordIndexCheck[vi,vk] = True
-            self.dVisualWordIndexCheck[vk,vi] = True
-            self.edgeIndexHash[(vi,vj,int(edgeij_anglei)/24,int(edgeij_anglej)/24)] = True
-            self.edgeIndexHash[(vj,vi,int(edgeij_anglej)/24,int(edgeij_anglei)/24)] = True
-            self.edgeIndexHash[(vj,vk,int(edgejk_anglej)/24,int(edgejk_anglek)/24)] = True
-            self.edgeIndexHash[(vk,vj,int(edgejk_anglek)/24,int(edgejk_anglej)/24)] = True
-            self.edgeIndexHash[(vi,vk,int(edgeik_anglei)/24,int(edgeik_anglek)/24)] = True
-            self.edgeIndexHash[(vk,vi,int(edgeik_anglek)/24,int(edgeik_anglei)/24)] = True
-            vi = vi*1000
-            vj = vj*1000
-            vk = vk*1000
-            delta3 = 180.0-delta1-delta2
-            self.trianglesIndexLSH.index([vi,vj,vk,delta1,delta2,edgeij_anglei,edgejk_anglej,edgeik_anglek],extra_data=str(x))
-            self.trianglesIndexLSH.index([vi,vk,vj,delta1,delta3,edgeik_anglei,edgejk_anglek,edgeij_anglej],extra_data=str(x))
-            self.trianglesIndexLSH.index([vj,vi,vk,delta2,delta1,edgeij_anglej,edgeik_anglei,edgejk_anglek],extra_data=str(x))
-            self.trianglesIndexLSH.index([vj,vk,vi,delta2,delta3,edgejk_anglej,edgeik_anglek,edgeij_anglei],extra_data=str(x))
-            self.trianglesIndexLSH.index([vk,vi,vj,delta3,delta1,edgeik_anglek,edgeij_anglei,edgejk_anglej],extra_data=str(x))
-            self.trianglesIndexLSH.index([vk,vj,vi,delta3,delta2,edgejk_anglek,edgeij_anglej,edgeik_anglei],extra_data=str(x))
-
-            x=x+1
-
-    def training_imageSet(self,setOfimgPaths):
+            features.append([keyInTriangleLabelIDDict[i],keyInTriangleLabelIDDict[j],keyInTriangleLabelIDDict[k],delta1,delta2,alpha,beta,gamma,edgeij_anglej,edgejk_anglek,edgeik_anglei])
+
+        record.lap('features')
+        record.count('edges',len(indexOfEdgePairs))
+        record.count('triangles',len(features))
+        record.count('descriptors',len(descriptors))
+        self.instrumentation.finish(record)
+        return trianglePositions,descriptors,features
+
+    def merge_pair_training(self, result):
+        # Appends a pair_training result, moving its descriptor ids behind the
+        # descriptors already in the model
+        trianglePositions,descriptors,features = result
+        indexOfIDstartPosition = len(self.trainedDescriptorsList)
+        self.trianglePositionList.extend(trianglePositions)
+        self.trainedDescriptorsList.extend(descriptors)
+        for feature in features:
+            self.triangleVWwith6anglesFeatureList.append([feature[0]+indexOfIDstartPosition,feature[1]+indexOfIDstartPosition,feature[2]+indexOfIDstartPosition]+list(feature[3:]))
+
+    def generate_EdgeandTriangle_LSH(self, start=0):
+        # Indexes the triangles from triangleVWwith6anglesFeatureList[start]
+        # on, the earlier ones are already in the indexes
+        wordPairs,edges,trianglePoints = triangle_generator.triangleIndexEntries(self.triangleVWwith6anglesFeatureList[start:],self.visualWordLabelIDs)
+        self.dVisualWordIndexCheck[wordPairs[:,0],wordPairs[:,1]] = True
+        self.edgeIndexHash.add(edges[:,0],edges[:,1],edges[:,2],edges[:,3])
+        # Every vertex order of a triangle is indexed, all under the triangle number
+        triangleExtraData = [str(x) for x in range(start,start+len(trianglePoints)//6) for _ in range(6)]
+        self.trianglesIndexLSH.index_batch(trianglePoints,extra_data=triangleExtraData)
+
+    def train_pairs(self, pairPaths, workers=1):
+        # Trains the (img1path,img2path) pairs and merges them into the model
+        # in order. workers > 1 trains them in a process pool, the model is
+        # identical to serial training.
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, _init_pair_worker, (self.logo_name,))
+            try:
+                for result in pool.imap(_pair_training_job, pairPaths, chunksize=4):
+                    self.merge_pair_training(result)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for img1path,img2path in pairPaths:
+                self.image_training(img1path,img2path)
+
+    def training_imageSet(self,setOfimgPaths,workers=1,vocabularyBuilder=None):
+        # vocabularyBuilder clusters the descriptors into visual words, see
+        # vocabulary.py. The default is a seeded mini-batch k-means.
+        if vocabularyBuilder is None:
+            vocabularyBuilder = vocabulary.MiniBatchVocabulary(2000)
         imgCount = len(setOfimgPaths)
         # for test, should not use it
         # for i in range(imgCount-1):
         #     for j in range(i+1,imgCount):
         tStart = time.time()
-        for i in range(imgCount):
-            for j in range(imgCount):
-                if i != j:
-                    self.image_training(setOfimgPaths[i],setOfimgPaths[j])
+        record = self.instrumentation.begin('training',self.logo_name)
+        pairPaths = [(setOfimgPaths[i],setOfimgPaths[j]) for i in range(imgCount) for j in range(imgCount) if i != j]
+        self.train_pairs(pairPaths,workers)
+        self.trainedImagePaths = self.trainedImagePaths + list(setOfimgPaths)
+        record.lap('pairs')
         desArray = np.asarray(self.trainedDescriptorsList)
-        self.centroidsOfKmean2000 = kmeans(desArray, 2000)
-        self.visualWordLabelIDs  = list(vq(desArray, self.centroidsOfKmean2000[0])[0])
+        self.centroidsOfKmean2000 = vocabularyBuilder.build(desArray)
+        if len(self.centroidsOfKmean2000[0]) > self.dVisualWordIndexCheck.words:
+            self.dVisualWordIndexCheck = edge_index.WordPairIndex(len(self.centroidsOfKmean2000[0]))
+        record.lap('vocabulary')
+        # training and recognition assign visual words with the same tree
+        self.wordAssigner = vocabulary.VocabularyTree(self.centroidsOfKmean2000[0])
+        self.visualWordLabelIDs  = list(self.wordAssigner.assign(desArray))
+        print "visual word agreement with vq: %f" % self.wordAssigner.measureAgreement(desArray)
+        record.lap('words')
         self.generate_EdgeandTriangle_LSH()
-
-        data = (
-                self.trianglePositionList,
-                self.trainedDescriptorsList ,
-                self.centroidsOfKmean2000,
-                self.visualWordLabelIDs,
-                self.trianglesIndexLSH,
-                self.triangleVWwith6anglesFeatureList,
-                self.dVisualWordIndexCheck,
-                self.edgeIndexHash)
-
-
-        FS = FeatureStorage(self.logo_name)
-        FS.save(data)
+        record.lap('index')
+
+        self.save_model()
+        record.lap('save')
+        record.count('images',imgCount)
+        record.count('pairs',len(pairPaths))
+        record.count('descriptors',len(desArray))
+        record.count('triangles',len(self.triangleVWwith6anglesFeatureList))
+        self.instrumentation.finish(record)
         tEnd = time.time()
         print "cost %f sec" % (tEnd - tStart)
 
+    def add_images(self, newImgPaths, workers=1):
+        # Adds images to a trained model. Only the pairs involving a new image
+        # are trained (new x existing, existing x new and new x new), their
+        # descriptors get words of the existing vocabulary and their triangles
+        # are appended to the indexes, so the cost follows the new pairs.
+        # The vocabulary is not rebuilt, retrain with training_imageSet once
+        # the added images outgrow it.
+        if self.wordAssigner is None:
+            raise ValueError('%s has no trained model to add images to' % self.logo_name)
+        tStart = time.time()
+        record = self.instrumentation.begin('add_images',self.logo_name)
+        existing = list(self.trainedImagePaths)
+        newImgPaths = [path for path in newImgPaths if path not in existing]
+        pairPaths = [(img1path,img2path) for img1path in newImgPaths for img2path in existing]
+        pairPaths += [(img1path,img2path) for img1path in existing for img2path in newImgPaths]
+        pairPaths += [(img1path,img2path) for img1path in newImgPaths for img2path in newImgPaths if img1path != img2path]
+
+        descriptorStart = len(self.trainedDescriptorsList)
+        triangleStart = len(self.triangleVWwith6anglesFeatureList)
+        self.train_pairs(pairPaths,workers)
+        self.trainedImagePaths = existing + newImgPaths
+        record.lap('pairs')
+
+        newDescriptors = np.asarray(self.trainedDescriptorsList[descriptorStart:]).reshape(-1,128)
+        self.visualWordLabelIDs = list(self.visualWordLabelIDs) + list(self.wordAssigner.assign(newDescriptors))
+        record.lap('words')
+        self.generate_EdgeandTriangle_LSH(triangleStart)
+        record.lap('index')
+
+        self.save_model()
+        record.lap('save')
+        record.count('images',len(newImgPaths))
+        record.count('pairs',len(pairPaths))
+        record.count('descriptors',len(newDescriptors))
+        record.count('triangles',len(self.triangleVWwith6anglesFeatureList)-triangleStart)
+        self.instrumentation.finish(record)
+        print "added %d images, %d pairs, %d triangles, cost %f sec" % (len(newImgPaths),len(pairPaths),
+            len(self.triangleVWwith6anglesFeatureList)-triangleStart,time.time()-tStart)
+
 if __name__ == '__main__':
    trHandler = TrainingHandler('adidas')
    tStart = time.time()
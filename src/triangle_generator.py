@@ -0,0 +1,114 @@
+import numpy as np
+import edge_index
+
+
+def enumerateTriangles(I, J, n=None):
+    # Every triangle of the undirected edge graph (I[e],J[e]), exactly once, as
+    # an (m,3) int array with columns i < j < k. Edges are kept in CSR order by
+    # their smaller vertex, each edge (i,j) is extended by the edges (j,k) with
+    # k > j, and the wedge is kept when the closing edge (i,k) exists.
+    I = np.asarray(I,np.int64).ravel()
+    J = np.asarray(J,np.int64).ravel()
+    if len(I) == 0:
+        return np.zeros((0,3),np.intp)
+    if n is None:
+        n = int(max(I.max(),J.max())) + 1
+
+    lo = np.minimum(I,J)
+    hi = np.maximum(I,J)
+    keys = np.unique((lo*n + hi)[lo != hi])
+    lo = keys // n
+    hi = keys % n
+
+    starts = np.searchsorted(lo,np.arange(n+1))
+    counts = starts[hi+1] - starts[hi]
+    total = counts.sum()
+    if total == 0:
+        return np.zeros((0,3),np.intp)
+
+    edge = np.repeat(np.arange(len(keys)),counts)
+    offset = np.arange(total) - np.repeat(np.cumsum(counts) - counts,counts)
+    ti = lo[edge]
+    tj = hi[edge]
+    tk = hi[np.repeat(starts[hi],counts) + offset]
+
+    closing = ti*n + tk
+    pos = np.searchsorted(keys,closing)
+    pos[pos == len(keys)] = 0
+    found = keys[pos] == closing
+    return np.column_stack((ti[found],tj[found],tk[found])).astype(np.intp)
+
+def _vertexAngle(ux, uy, lu, vx, vy, lv):
+    # Angle in degrees between u and v, zero lengths count as 1.0
+    lu = np.where(lu == 0.0,1.0,lu)
+    lv = np.where(lv == 0.0,1.0,lv)
+    vcos = (ux*vx+uy*vy)/lu/lv
+    return np.degrees(np.arccos(np.clip(np.round(vcos,13),-1.0,1.0)))
+
+def triangleShape(points, triangles):
+    # points are in ->x ^y coordinates. Returns the edge vectors ij, jk, ik,
+    # their lengths, and delta1/delta2, the inner angles at vertex i and j.
+    triangles = np.asarray(triangles,np.intp).reshape(-1,3)
+    pi = points[triangles[:,0]]
+    pj = points[triangles[:,1]]
+    pk = points[triangles[:,2]]
+    vij = pj - pi
+    vjk = pk - pj
+    vik = pk - pi
+    length_vij = np.sqrt(np.abs(vij[:,0]*vij[:,0]+vij[:,1]*vij[:,1]))
+    length_vjk = np.sqrt(np.abs(vjk[:,0]*vjk[:,0]+vjk[:,1]*vjk[:,1]))
+    length_vik = np.sqrt(np.abs(vik[:,0]*vik[:,0]+vik[:,1]*vik[:,1]))
+    delta1 = _vertexAngle(vik[:,0],vik[:,1],length_vik,vij[:,0],vij[:,1],length_vij)
+    delta2 = _vertexAngle(vjk[:,0],vjk[:,1],length_vjk,-vij[:,0],-vij[:,1],length_vij)
+    return vij,vjk,vik,length_vij,length_vjk,length_vik,delta1,delta2
+
+def triangleConstraintMask(points, triangles, minDist, minAngle, eccLower, eccUpper):
+    # Distance, eccentricity and angle constraints used when training triangles.
+    # Returns the mask of accepted triangles together with delta1 and delta2.
+    vij,vjk,vik,length_vij,length_vjk,length_vik,delta1,delta2 = triangleShape(points,triangles)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        ratioi = length_vij/length_vik
+        ratioj = length_vjk/length_vij
+    keep = (length_vik >= minDist) & (length_vij >= minDist) & (length_vjk >= minDist)
+    keep &= (ratioi >= eccLower) & (ratioi <= eccUpper)
+    keep &= (ratioj >= eccLower) & (ratioj <= eccUpper)
+    keep &= (delta1 >= minAngle) & (delta2 >= minAngle)
+    return keep,delta1,delta2
+
+def triangleIndexEntries(features, labels):
+    # Index entries of trained triangles. features are the rows of
+    # triangleVWwith6anglesFeatureList, labels maps their descriptor ids to
+    # visual words. Returns the co-occurring word pairs (m,2), both directions
+    # of every edge as (vi,vj,alphabin,betabin) rows, and the six LSH points of
+    # every triangle, one per vertex order, triangle after triangle.
+    features = np.asarray(features,float).reshape(-1,11)
+    labels = np.asarray(labels,np.int64)
+    vi = labels[features[:,0].astype(np.intp)]
+    vj = labels[features[:,1].astype(np.intp)]
+    vk = labels[features[:,2].astype(np.intp)]
+    delta1 = features[:,3]
+    delta2 = features[:,4]
+    edgeij_anglei,edgejk_anglej,edgeik_anglek = features[:,5],features[:,6],features[:,7]
+    edgeij_anglej,edgejk_anglek,edgeik_anglei = features[:,8],features[:,9],features[:,10]
+
+    wordPairs = np.column_stack((np.concatenate([vi,vj,vi]),np.concatenate([vj,vk,vk])))
+
+    bins = edge_index.angleBins
+    edges = np.column_stack((
+        np.concatenate([vi,vj,vj,vk,vi,vk]),
+        np.concatenate([vj,vi,vk,vj,vk,vi]),
+        bins(np.concatenate([edgeij_anglei,edgeij_anglej,edgejk_anglej,edgejk_anglek,edgeik_anglei,edgeik_anglek])),
+        bins(np.concatenate([edgeij_anglej,edgeij_anglei,edgejk_anglek,edgejk_anglej,edgeik_anglek,edgeik_anglei]))))
+
+    vi = vi*1000
+    vj = vj*1000
+    vk = vk*1000
+    delta3 = 180.0-delta1-delta2
+    trianglePoints = np.stack([
+        np.column_stack((vi,vj,vk,delta1,delta2,edgeij_anglei,edgejk_anglej,edgeik_anglek)),
+        np.column_stack((vi,vk,vj,delta1,delta3,edgeik_anglei,edgejk_anglek,edgeij_anglej)),
+        np.column_stack((vj,vi,vk,delta2,delta1,edgeij_anglej,edgeik_anglei,edgejk_anglek)),
+        np.column_stack((vj,vk,vi,delta2,delta3,edgejk_anglej,edgeik_anglek,edgeij_anglei)),
+        np.column_stack((vk,vi,vj,delta3,delta1,edgeik_anglek,edgeij_anglei,edgejk_anglej)),
+        np.column_stack((vk,vj,vi,delta3,delta2,edgejk_anglek,edgeij_anglej,edgeik_anglei))],axis=1).reshape(-1,8)
+    return wordPairs,edges,trianglePoints
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import multiprocessing
+import numpy as np
+
+import cascade
+import feature_cache
+import model_registry
+from recognizer import Recognizer
+
+# Registry and recognizer of a validation worker process
+_workerRegistry = None
+_workerRecognizer = None
+
+def _init_validation_worker(memoryBudgetMB):
+    global _workerRegistry, _workerRecognizer
+    _workerRegistry = model_registry.ModelRegistry(memoryBudgetMB)
+    _workerRecognizer = Recognizer()
+
+def _validation_job(job):
+    # Matches images against one class model, returns their records
+    logo_name, modelStamp, imgPaths = job
+    records = []
+    try:
+        trHandler = _workerRegistry.get(logo_name)
+    except Exception as e:
+        trHandler = None
+        error = 'model: %r' % (e,)
+    for imgPath in imgPaths:
+        record = {'logo': logo_name, 'model': modelStamp, 'path': imgPath,
+                  'matches': 0, 'pairs': 0, 'triangles': 0, 'seconds': 0.0, 'error': None}
+        if trHandler is None:
+            record['error'] = error
+        else:
+            try:
+                kp, des = feature_cache.sharedCache().detectAndCompute(imgPath)
+                result = _workerRecognizer.matchFeatures(kp, des, trHandler, imgPath)
+                for key in ('matches', 'pairs', 'triangles', 'seconds'):
+                    record[key] = result[key]
+            except Exception as e:
+                record['error'] = '%r' % (e,)
+        records.append(record)
+    return records
+
+
+def _makeDirectory(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+def bestThreshold(positives, negatives):
+    # The match count threshold t (logo when matches >= t) with the best F1
+    # on the given counts, the higher t on ties. Returns (t, precision,
+    # recall, f1).
+    positives = np.sort(np.asarray(positives, int))
+    negatives = np.sort(np.asarray(negatives, int))
+    if len(positives) == 0:
+        return None, 0.0, 0.0, 0.0
+    # only positive counts can be best, t above them all finds nothing
+    candidates = np.unique(positives)
+    tp = len(positives) - np.searchsorted(positives, candidates)
+    fp = len(negatives) - np.searchsorted(negatives, candidates)
+    f1 = 2.0*tp/(2*tp + fp + len(positives) - tp)
+    best = len(candidates) - 1 - np.argmax(f1[::-1])
+    precision = float(tp[best])/(tp[best] + fp[best])
+    recall = float(tp[best])/len(positives)
+    return int(candidates[best]), precision, recall, float(f1[best])
+
+def classSummary(positives, negatives):
+    threshold, precision, recall, f1 = bestThreshold(positives, negatives)
+    summary = {'positives': len(positives), 'negatives': len(negatives),
+               'threshold': threshold, 'precision': precision, 'recall': recall, 'f1': f1}
+    if positives or negatives:
+        thresholds = cascade.CascadeThresholds.fromCounts(positives, negatives)
+        summary['cascade'] = {'accept': thresholds.accept, 'reject': thresholds.reject}
+    return summary
+
+
+class ValidationDriver:
+    # Matches every validation image against every logo class model in a
+    # process pool. Each finished image is appended to a checkpoint file
+    # right away, a run that was interrupted goes on with the images left.
+    # Images of a class are positives of that class, all others negatives.
+    # The counts give the triangleCounter/<logo> files and per-class
+    # thresholds with their precision and recall.
+    def __init__(self, getImagePath, workers=None, checkpointPath='../validation/valset.jsonl', chunkSize=16, memoryBudgetMB=1024):
+        self.getImagePath = getImagePath
+        self.workers = workers or multiprocessing.cpu_count()
+        self.checkpointPath = checkpointPath
+        # images per job, a job loads its class model once
+        self.chunkSize = chunkSize
+        # model registry budget of each worker
+        self.memoryBudgetMB = memoryBudgetMB
+        self.registry = model_registry.ModelRegistry(memoryBudgetMB)
+
+    def summaryPath(self):
+        # read by cascade.loadThresholds, the default checkpoint gives
+        # cascade.SUMMARY_PATH
+        return os.path.splitext(self.checkpointPath)[0] + '.summary.json'
+
+    def validationImages(self, logo_classes):
+        # {logo_name: valset image paths}, classes without validation images
+        # get none. A valset that cannot be read raises.
+        images = {}
+        for logo_name in logo_classes:
+            if self.getImagePath.hasClass(logo_name,2):
+                images[logo_name] = self.getImagePath.getImagePath(logo_name,2)
+            else:
+                images[logo_name] = []
+        return images
+
+    def modelStamp(self, logo_name):
+        # Identity of the model file, records of an older model are redone
+        stamp = self.registry.fileStamp(logo_name)
+        if stamp is None:
+            return None
+        return [stamp[1], stamp[2], stamp[3]]
+
+    def readCheckpoint(self):
+        # {(logo_name, imgPath): record} of the images finished without error,
+        # a line cut short by an interruption is ignored
+        done = {}
+        if not os.path.isfile(self.checkpointPath):
+            return done
+        fh = open(self.checkpointPath, 'r')
+        try:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('error') is None:
+                    done[(record['logo'], record['path'])] = record
+        finally:
+            fh.close()
+        return done
+
+    def schedule(self, logo_classes, images, done):
+        # (logo_name, modelStamp, imgPaths) jobs of the images not yet matched
+        # against the current model of each class
+        allImages = [imgPath for logo_name in sorted(images) for imgPath in images[logo_name]]
+        jobs = []
+        for logo_name in logo_classes:
+            if 'no-logo' in logo_name:
+                continue
+            stamp = self.modelStamp(logo_name)
+            if stamp is None:
+                print 'Logo:', logo_name, 'has no model'
+                continue
+            todo = [imgPath for imgPath in allImages
+                    if done.get((logo_name, imgPath), {}).get('model') != stamp]
+            for start in range(0, len(todo), self.chunkSize):
+                jobs.append((logo_name, stamp, todo[start:start+self.chunkSize]))
+        return jobs
+
+    def validate(self, logo_classes):
+        # Runs the images left and returns the summary of every class
+        images = self.validationImages(logo_classes)
+        done = self.readCheckpoint()
+        jobs = self.schedule(logo_classes, images, done)
+        tStart = time.time()
+        if jobs:
+            _makeDirectory(self.checkpointPath)
+            total = sum(len(job[2]) for job in jobs)
+            finished = 0
+            fh = open(self.checkpointPath, 'a+')
+            # a line cut short by an interruption is ended, so the next
+            # record starts on a line of its own
+            fh.seek(0, os.SEEK_END)
+            if fh.tell() > 0:
+                fh.seek(-1, os.SEEK_END)
+                if fh.read(1) != '\n':
+                    fh.seek(0, os.SEEK_END)
+                    fh.write('\n')
+            pool = multiprocessing.Pool(min(self.workers, len(jobs)), _init_validation_worker, (self.memoryBudgetMB,))
+            try:
+                for records in pool.imap_unordered(_validation_job, jobs):
+                    for record in records:
+                        fh.write(json.dumps(record, sort_keys=True) + '\n')
+                        if record['error'] is None:
+                            done[(record['logo'], record['path'])] = record
+                        else:
+                            print 'Logo:', record['logo'], record['path'], record['error']
+                    fh.flush()
+                    finished += len(records)
+                    print 'validated %d/%d images, cost %f sec' % (finished, total, time.time() - tStart)
+            finally:
+                pool.close()
+                pool.join()
+                fh.close()
+        return self.summarize(logo_classes, images, done)
+
+    def summarize(self, logo_classes, images, done):
+        # Writes triangleCounter/<logo> and the summary file from the records
+        # of the current models, returns {logo_name: summary}
+        summary = {}
+        for logo_name in logo_classes:
+            if 'no-logo' in logo_name:
+                continue
+            stamp = self.modelStamp(logo_name)
+            counts = []
+            for imageClass in sorted(images):
+                for imgPath in images[imageClass]:
+                    record = done.get((logo_name, imgPath))
+                    if record is not None and record['model'] == stamp:
+                        counts.append((imgPath, record['matches'], imageClass == logo_name))
+            if not counts:
+                continue
+            self.writeCounter(logo_name, counts)
+            summary[logo_name] = classSummary([matches for imgPath, matches, positive in counts if positive],
+                                              [matches for imgPath, matches, positive in counts if not positive])
+            print 'Logo:', logo_name, 'threshold', summary[logo_name]['threshold'], \
+                'precision %f recall %f' % (summary[logo_name]['precision'], summary[logo_name]['recall'])
+
+        path = self.summaryPath()
+        _makeDirectory(path)
+        tmpPath = '%s.%d.tmp' % (path, os.getpid())
+        fh = open(tmpPath, 'w')
+        try:
+            json.dump(summary, fh, indent=2, sort_keys=True)
+        finally:
+            fh.close()
+        os.rename(tmpPath, path)
+        return summary
+
+    def writeCounter(self, logo_name, counts):
+        # Same format as Recognizer.writeImgTriangleCounter, read by cascade
+        path = cascade.counterPath(logo_name)
+        _makeDirectory(path)
+        tmpPath = '%s.%d.tmp' % (path, os.getpid())
+        f = open(tmpPath, 'w')
+        try:
+            for imgPath, matches, positive in counts:
+                f.write(imgPath + ',' + str(matches) + '\n')
+        finally:
+            f.close()
+        os.rename(tmpPath, path)
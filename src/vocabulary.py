@@ -0,0 +1,200 @@
+import numpy as np
+from scipy import sparse
+from scipy.cluster.vq import vq, kmeans
+
+# Builders of the visual vocabulary. build(descriptors) returns the same
+# (centroids, distortion) tuple as scipy.cluster.vq.kmeans, which is what
+# TrainingHandler keeps in centroidsOfKmean2000.
+
+
+def nearestCentroid(points, centroids, chunk=8192):
+    # Index and distance of the nearest centroid of every row of points. Same
+    # result as vq up to rounding, but the distances come from one matrix
+    # product per chunk: |x|^2 - 2 x.c + |c|^2. SIFT descriptors stay float32.
+    dtype = np.result_type(np.asarray(points).dtype,np.asarray(centroids).dtype,np.float32)
+    points = np.asarray(points,dtype)
+    centroids = np.asarray(centroids,dtype)
+    cnorm = (centroids*centroids).sum(axis=1)
+    labels = np.zeros(len(points),np.intp)
+    dists = np.zeros(len(points),float)
+    for start in range(0,len(points),chunk):
+        block = points[start:start+chunk]
+        d2 = np.dot(block,centroids.T)
+        d2 *= -2.0
+        d2 += cnorm
+        blockLabels = d2.argmin(axis=1)
+        labels[start:start+chunk] = blockLabels
+        d2 = d2[np.arange(len(block)),blockLabels] + (block*block).sum(axis=1)
+        dists[start:start+chunk] = np.sqrt(np.maximum(d2,0.0))
+    return labels,dists
+
+def saveVocabulary(path, centroids):
+    np.save(path, np.asarray(centroids))
+
+def loadVocabulary(path):
+    return np.load(path)
+
+
+class KMeansVocabulary:
+    # Full scipy k-means over every descriptor, the original training step
+    def __init__(self, words=2000):
+        self.words = words
+
+    def build(self, descriptors):
+        return kmeans(np.asarray(descriptors), self.words)
+
+
+class MiniBatchVocabulary:
+    # Mini-batch k-means (Sculley, Web-scale k-means clustering) on a random
+    # sample of at most sampleSize descriptors. Every iteration assigns a
+    # batch to the nearest centroids and moves each centroid to the running
+    # mean of the descriptors it got so far. The cost depends on sampleSize,
+    # batchSize and iterations only, not on the number of descriptors, and the
+    # result is reproducible for a given seed.
+    def __init__(self, words=2000, sampleSize=200000, batchSize=2048, iterations=100, tolerance=1e-4, seed=0):
+        self.words = words
+        self.sampleSize = sampleSize
+        self.batchSize = batchSize
+        self.iterations = iterations
+        # stop when no centroid moved more than this, relative to the spread
+        self.tolerance = tolerance
+        self.seed = seed
+
+    def build(self, descriptors):
+        descriptors = np.asarray(descriptors)
+        random = np.random.RandomState(self.seed)
+        if len(descriptors) > self.sampleSize:
+            sample = descriptors[np.sort(random.choice(len(descriptors),self.sampleSize,replace=False))]
+        else:
+            sample = descriptors
+        sample = np.asarray(sample,np.result_type(sample.dtype,np.float32))
+
+        words = min(self.words,len(sample))
+        centroids = sample[random.choice(len(sample),words,replace=False)].copy()
+        counts = np.zeros(words,sample.dtype)
+        scale = max(float(sample.std()),1e-12)
+
+        for iteration in range(self.iterations):
+            batch = sample[random.randint(0,len(sample),min(self.batchSize,len(sample)))]
+            labels = nearestCentroid(batch,centroids)[0]
+            batchCounts = np.bincount(labels,minlength=words).astype(sample.dtype)
+            # per centroid sums of the batch rows, as a (words,batch) 0/1 matrix product
+            sums = sparse.csr_matrix((np.ones(len(labels),sample.dtype),(labels,np.arange(len(labels)))),shape=(words,len(batch))).dot(batch)
+            hit = batchCounts > 0
+            counts[hit] += batchCounts[hit]
+            step = (sums[hit] - batchCounts[hit,None]*centroids[hit]) / counts[hit,None]
+            centroids[hit] += step
+            if len(step) == 0 or np.abs(step).max() < self.tolerance*scale:
+                break
+
+        distortion = nearestCentroid(sample,centroids)[1].mean()
+        return centroids.astype(descriptors.dtype),distortion
+
+
+class PrebuiltVocabulary:
+    # Centroids saved with saveVocabulary, used as they are instead of
+    # clustering again
+    def __init__(self, path, sampleSize=10000, seed=0):
+        self.path = path
+        # the distortion is only estimated on a sample
+        self.sampleSize = sampleSize
+        self.seed = seed
+
+    def build(self, descriptors):
+        descriptors = np.asarray(descriptors)
+        centroids = loadVocabulary(self.path)
+        if len(descriptors) == 0:
+            return centroids,0.0
+        if len(descriptors) > self.sampleSize:
+            random = np.random.RandomState(self.seed)
+            descriptors = descriptors[random.choice(len(descriptors),self.sampleSize,replace=False)]
+        distortion = nearestCentroid(descriptors,centroids)[1].mean()
+        return centroids.astype(descriptors.dtype),distortion
+
+
+class VocabularyTree(object):
+    # Approximate visual word assignment, a two level tree over the centroids.
+    # The centroids are clustered into groups, a descriptor is compared with
+    # the group centers first and then only with the centroids of its probes
+    # nearest groups. More probes find the exact nearest centroid more often
+    # and cost more, probes >= groups is the same as vq. Built once per model
+    # and saved with it.
+    def __init__(self, centroids, groups=64, probes=4, seed=0):
+        self.centroids = np.asarray(centroids,np.result_type(np.asarray(centroids).dtype,np.float32))
+        self.probes = probes
+        groups = max(1,min(groups,len(self.centroids)))
+        groupCenters = MiniBatchVocabulary(groups,batchSize=len(self.centroids),iterations=20,seed=seed).build(self.centroids)[0]
+        groupOfWord = nearestCentroid(self.centroids,groupCenters)[0]
+        # centroid ids of every group, CSR layout
+        self.wordOrder = np.argsort(groupOfWord,kind='mergesort')
+        self.groupStarts = np.searchsorted(groupOfWord[self.wordOrder],np.arange(len(groupCenters)+1))
+        # a group center is the mean of the centroids in it
+        self.groupCenters = np.array([self.centroids[self.wordOrder[self.groupStarts[g]:self.groupStarts[g+1]]].mean(axis=0)
+                                      if self.groupStarts[g+1] > self.groupStarts[g] else groupCenters[g]
+                                      for g in range(len(groupCenters))],self.centroids.dtype)
+        self.wordNorms = (self.centroids*self.centroids).sum(axis=1)
+        self.groupNorms = (self.groupCenters*self.groupCenters).sum(axis=1)
+        # share of descriptors assigned like vq, see measureAgreement
+        self.agreementRate = None
+
+    _ARRAYS = ('centroids','wordOrder','groupStarts','groupCenters','wordNorms','groupNorms')
+
+    def toArrays(self):
+        return dict((name,getattr(self,name)) for name in self._ARRAYS)
+
+    @classmethod
+    def fromArrays(cls, arrays, probes=4, agreementRate=None):
+        tree = cls.__new__(cls)
+        for name in cls._ARRAYS:
+            setattr(tree,name,arrays[name])
+        tree.probes = probes
+        tree.agreementRate = agreementRate
+        return tree
+
+    def assign(self, points, probes=None, chunk=8192):
+        # Visual word of every row of points
+        if probes is None:
+            probes = self.probes
+        points = np.asarray(points,self.centroids.dtype).reshape(-1,self.centroids.shape[1])
+        groups = len(self.groupCenters)
+        if probes >= groups:
+            return nearestCentroid(points,self.centroids,chunk)[0]
+
+        labels = np.zeros(len(points),np.intp)
+        for start in range(0,len(points),chunk):
+            block = points[start:start+chunk]
+            n = len(block)
+            # |x|^2 is the same for every candidate of a row and left out
+            coarse = self.groupNorms - 2.0*np.dot(block,self.groupCenters.T)
+            probe = np.argpartition(coarse,probes-1,axis=1)[:,:probes].ravel()
+            probeRow = np.repeat(np.arange(n),probes)
+            order = np.argsort(probe,kind='mergesort')
+            bounds = np.searchsorted(probe[order],np.arange(groups+1))
+
+            best = np.full(n,np.inf)
+            bestWord = np.zeros(n,np.intp)
+            for g in range(groups):
+                rows = probeRow[order[bounds[g]:bounds[g+1]]]
+                words = self.wordOrder[self.groupStarts[g]:self.groupStarts[g+1]]
+                if len(rows) == 0 or len(words) == 0:
+                    continue
+                d2 = self.wordNorms[words] - 2.0*np.dot(block[rows],self.centroids[words].T)
+                nearest = d2.argmin(axis=1)
+                d2 = d2[np.arange(len(rows)),nearest]
+                better = d2 < best[rows]
+                best[rows[better]] = d2[better]
+                bestWord[rows[better]] = words[nearest[better]]
+            labels[start:start+n] = bestWord
+        return labels
+
+    def measureAgreement(self, points, sampleSize=10000, seed=0):
+        # Share of rows of points (at most sampleSize of them) whose word is
+        # the one exact vq finds, kept in agreementRate
+        points = np.asarray(points)
+        if len(points) > sampleSize:
+            points = points[np.random.RandomState(seed).choice(len(points),sampleSize,replace=False)]
+        if len(points) == 0:
+            return self.agreementRate
+        exact = vq(np.asarray(points,self.centroids.dtype),self.centroids)[0]
+        self.agreementRate = float((self.assign(points) == exact).mean())
+        return self.agreementRate